@@ -0,0 +1,42 @@
+# ==========================
+# Антифлуд: ведро токенов на пользователя
+#
+# У каждого пользователя своё ведро на каждый вид апдейтов (кнопки,
+# сообщения, сообщения операторам): burst штук подряд, дальше rate в
+# секунду. Лишнее молча отбрасывается ещё до обработчиков, так что один
+# клиент не съест ни общий лимит бота, ни лимит чата операторов.
+#
+# Ведро хранится одним числом — моментом, когда оно снова станет полным
+# (GCRA). Полное ведро ничем не отличается от отсутствующего, поэтому
+# prune() просто удаляет всех, у кого этот момент уже прошёл.
+# ==========================
+import time
+
+
+class TokenBucket:
+    __slots__ = ("interval", "capacity", "_full_at")
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1 / rate  # сколько секунд восстанавливается один токен
+        self.capacity = burst * self.interval
+        self._full_at = {}  # user_id -> когда ведро снова полное (time.monotonic)
+
+    def allow(self, user_id: int, now: float = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        full_at = max(self._full_at.get(user_id, now), now) + self.interval
+        if full_at - now > self.capacity:
+            return False
+        self._full_at[user_id] = full_at
+        return True
+
+    def prune(self, now: float = None) -> int:
+        if now is None:
+            now = time.monotonic()
+        idle = [user_id for user_id, full_at in self._full_at.items() if full_at <= now]
+        for user_id in idle:
+            del self._full_at[user_id]
+        return len(idle)
+
+    def __len__(self):
+        return len(self._full_at)
@@ -0,0 +1,1597 @@
+# ==========================
+# Локальные замеры без сети: поддельный Bot API + прогон апдейтов через бота
+#
+#   python bench.py webhook [-n 500]
+#   python bench.py concurrency [-n 200] [--latency 0.05]
+#   python bench.py restart [-n 500]
+#   python bench.py memory [-n 100000]
+#   python bench.py router [-n 100000]
+#   python bench.py roundtrips [-n 20] [--latency 0.05]
+#   python bench.py tickets [-n 300000]
+#   python bench.py phones [-n 100000]
+#   python bench.py relay [-n 300] [--relay-cache 100]
+#   python bench.py antiflood [-n 100] [--spammers 9] [--spam 300] [--latency 0.05]
+#   python bench.py digest [-n 100] [--ramp 3] [--chat-interval 0.3]
+#   python bench.py attachments [-n 50] [--album 5] [--flood 0.1]
+#   python bench.py suggest [-n 50000]
+#   python bench.py shards [-n 300] [--shards 1 2 4]
+#   python bench.py stats [-n 300000]
+#   python bench.py load [-n 300] [--latency 0.05] [--flood 0.01] [--think 0.5] [--metrics]
+# ==========================
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, deque
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler, filters
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application as TornadoApp, RequestHandler
+
+BOT_ID = 123456
+WEBHOOK_SECRET = "bench-secret"
+
+# ==========================
+# Поддельный Bot API
+# ==========================
+# Методы, на которые поддельный API может ответить 429 (как Telegram при флуде)
+FLOOD_METHODS = ("sendMessage", "editMessageText", "answerCallbackQuery")
+# attachments: 429 только на вложения операторам — их шлёт outbox, ответы клиентам не задеваются
+MEDIA_METHODS = ("sendMediaGroup", "sendDocument", "sendPhoto")
+# Сводка операторам: «📦 Сводка: N» и уведомления «[k] текст» через пустую строку
+DIGEST_ITEM = re.compile(r"\n\n\[\d+\] ")
+
+
+class TooManyRequests(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, flood: float = 0.0, retry_after: int = 1, seed: int = 0,
+                 flood_methods: tuple = FLOOD_METHODS):
+        self.latency = latency
+        self.flood = flood  # доля вызовов flood_methods, получающих 429
+        self.flood_methods = flood_methods
+        self.retry_after = retry_after
+        self.calls = []  # (время, метод, параметры) — только принятые
+        self.flooded = Counter()  # метод -> сколько раз ответили 429
+        self.waiters = {}  # chat_id -> Future, ждём ответа бота этому чату
+        self.sent = []  # (chat_id, message_id, text) отправленных sendMessage
+        self.received = Counter()  # метод -> байт в телах запросов
+        self.updates = deque()  # очередь для getUpdates
+        self._updates_ready = asyncio.Event()
+        self._random = random.Random(seed)
+        self._message_id = 0
+        self._update_id = 0
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        logging.getLogger("tornado.access").setLevel(logging.ERROR)
+        sockets = bind_sockets(0, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        self._server = HTTPServer(TornadoApp([(r"/bot[^/]+/(\w+)", _FakeMethodHandler, {"api": self})]))
+        self._server.add_sockets(sockets)
+
+    async def stop(self):
+        # Даём досрочно брошенным запросам доиграть задержку
+        await asyncio.sleep(self.latency * 2)
+        self._updates_ready.set()
+        self._server.stop()
+        await self._server.close_all_connections()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def wait_for_chat(self, chat_id: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = fut
+        return fut
+
+    def count(self, method: str) -> int:
+        return sum(1 for _, m, _ in self.calls if m == method)
+
+    def notifications(self, chat_id: int) -> list:
+        # Тексты отправленного в чат; сводка раскладывается на уведомления в ней
+        texts = []
+        for _, m, p in self.calls:
+            if m == "sendMessage" and int(p["chat_id"]) == chat_id:
+                text = p["text"]
+                texts += DIGEST_ITEM.split(text)[1:] if p.get("reply_markup") and text.startswith("📦") else [text]
+        return texts
+
+    def count_to(self, chat_id: int) -> int:
+        return len(self.notifications(chat_id))
+
+    def push_update(self, data: dict):
+        # Номер присваиваем при постановке: getUpdates отдаёт их строго по возрастанию
+        self._update_id += 1
+        self.updates.append({**data, "update_id": self._update_id})
+        self._updates_ready.set()
+
+    async def get_updates(self, params: dict) -> list:
+        # Long polling: подтверждённые (id < offset) выбрасываем, новых ждём до timeout
+        offset = int(params.get("offset", 0))
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), float(params.get("timeout", 0)))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit", 100))
+        return [self.updates[i] for i in range(min(limit, len(self.updates)))]
+
+    async def call(self, method: str, params: dict):
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood and method in self.flood_methods and self._random.random() < self.flood:
+            self.flooded[method] += 1
+            raise TooManyRequests(self.retry_after)
+        self.calls.append((time.perf_counter(), method, params))
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ("sendMessage", "editMessageText", "copyMessage"):
+            chat_id = int(params.get("chat_id", 0))
+            fut = self.waiters.pop(chat_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result(time.perf_counter())
+            self._message_id += 1
+            if method == "copyMessage":
+                return {"message_id": self._message_id}
+            if method == "sendMessage":
+                self.sent.append((chat_id, self._message_id, params.get("text", "")))
+            return {
+                "message_id": int(params.get("message_id", self._message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        if method in ("sendPhoto", "sendDocument", "sendMediaGroup"):
+            chat = {"id": int(params["chat_id"]), "type": "private"}
+            messages = []
+            for _ in params.get("media") or [params]:
+                self._message_id += 1
+                messages.append({"message_id": self._message_id, "date": int(time.time()), "chat": chat})
+            return messages if method == "sendMediaGroup" else messages[0]
+        return True
+
+
+class _FakeMethodHandler(RequestHandler):
+    def initialize(self, api: FakeBotAPI):
+        self.api = api
+
+    async def post(self, method: str):
+        self.api.received[method] += len(self.request.body)
+        params = {}
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")  # так шлёт приёмник shards.py
+        for key, value in parse_qsl(self.request.body.decode()) if not params else ():
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        self.set_header("Content-Type", "application/json")
+        try:
+            result = await self.api.call(method, params)
+        except TooManyRequests as exc:
+            self.set_status(429)
+            self.finish(json.dumps({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {exc.retry_after}",
+                "parameters": {"retry_after": exc.retry_after},
+            }))
+            return
+        self.finish(json.dumps({"ok": True, "result": result}))
+
+
+# ==========================
+# Подготовка бота
+# ==========================
+def load_bot(api: FakeBotAPI):
+    os.environ["BOT_TOKEN"] = f"{BOT_ID}:bench"
+    os.environ["OPERATOR_CHAT_ID"] = "-100"
+    os.environ["BOT_API_URL"] = api.base_url
+    # Лимиты Telegram на чат операторов в замерах не нужны
+    os.environ["OUTBOX_CHAT_INTERVAL"] = "0"
+    os.environ["OUTBOX_GLOBAL_RATE"] = "0"
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    return main
+
+
+def fresh_storage(main):
+    # Каждый запуск — с чистыми базами
+    root = tempfile.mkdtemp(prefix="bench-")
+    main.OUTBOX_PATH = os.path.join(root, "outbox.db")
+    main.PERSISTENCE_PATH = os.path.join(root, "sessions.db")
+    main.TICKETS_PATH = os.path.join(root, "tickets.db")
+    main.RELAY_PATH = os.path.join(root, "relay.db")
+    return root
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+_update_id = 0
+
+def message_update(user_id: int, text: str) -> dict:
+    global _update_id
+    _update_id += 1
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {
+        "update_id": _update_id,
+        "message": {
+            "message_id": _update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    }
+
+
+def media_update(user_id: int, kind: str, file_id: str, media_group_id: str = None) -> dict:
+    data = message_update(user_id, "")
+    message = data["message"]
+    del message["text"], message["entities"]
+    if kind == "photo":
+        # Telegram присылает несколько размеров; боту нужен только file_id самого большого
+        message["photo"] = [{"file_id": f"{file_id}-{size}", "file_unique_id": f"{file_id}-{size}",
+                             "width": size, "height": size} for size in (90, 320, 1280)]
+    else:
+        message["document"] = {"file_id": file_id, "file_unique_id": file_id, "file_name": "scan.pdf",
+                               "file_size": 20 * 2 ** 20}
+    if media_group_id:
+        message["media_group_id"] = media_group_id
+    return data
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    global _update_id
+    _update_id += 1
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {
+        "update_id": _update_id,
+        "callback_query": {
+            "id": str(_update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def repair_flow(user_id: int) -> list:
+    return [
+        callback_update(user_id, "repair"),
+        message_update(user_id, f"Имя {user_id}"),
+        message_update(user_id, "050 123 45 67"),
+        message_update(user_id, "ноутбук"),
+        message_update(user_id, f"Brand{user_id}"),
+        message_update(user_id, f"Model{user_id}"),
+        message_update(user_id, "не включается"),
+        callback_update(user_id, "attach"),
+        callback_update(user_id, "confirm"),
+    ]
+
+
+async def start_bot(main, keep_storage: bool = False):
+    if not keep_storage:
+        fresh_storage(main)
+    app = main.build_app()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    return app
+
+
+async def stop_bot(app):
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+
+async def wait_until(predicate, timeout: float = 60.0):
+    deadline = time.perf_counter() + timeout
+    while not predicate() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+
+
+def replies_by_chat(api: FakeBotAPI) -> dict:
+    chats = {}
+    for _, method, params in api.calls:
+        if method in ("sendMessage", "editMessageText"):
+            chats.setdefault(int(params["chat_id"]), []).append(params["text"])
+    return chats
+
+
+def percentiles(values: list) -> str:
+    values = sorted(values)
+    if not values:
+        return "нет данных"
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))] * 1000
+    return f"p50={pick(0.50):.2f}ms p95={pick(0.95):.2f}ms p99={pick(0.99):.2f}ms max={values[-1] * 1000:.2f}ms"
+
+
+# ==========================
+# Webhook: апдейт → HTTP → бот → ответ в поддельный Bot API
+# ==========================
+async def bench_webhook(args):
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    main = load_bot(api)
+    fresh_storage(main)
+    app = main.build_app()
+    updates = main.allowed_updates(app)
+    port = free_port()
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.updater.start_webhook(
+        listen="127.0.0.1",
+        port=port,
+        url_path="telegram",
+        webhook_url="https://example.invalid/telegram",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=updates,
+    )
+    await app.start()
+
+    client = AsyncHTTPClient()
+    url = f"http://127.0.0.1:{port}/telegram"
+    headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+
+    # Чужой секрет должен отбиваться до очереди
+    try:
+        await client.fetch(url, method="POST", body=json.dumps(message_update(1, "/start")),
+                           headers={**headers, "X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        rejected = False
+    except HTTPClientError as exc:
+        rejected = exc.code == 403
+
+    latencies = []
+    started = time.perf_counter()
+    for i in range(args.n):
+        user_id = 1000 + i
+        replied = api.wait_for_chat(user_id)
+        t0 = time.perf_counter()
+        await client.fetch(url, method="POST", body=json.dumps(message_update(user_id, "/start")), headers=headers)
+        latencies.append(await asyncio.wait_for(replied, 5) - t0)
+    elapsed = time.perf_counter() - started
+
+    await app.updater.stop()
+    await stop_bot(app)
+    await api.stop()
+
+    set_webhook = [params for _, method, params in api.calls if method == "setWebhook"]
+    print(f"allowed_updates: {set_webhook[0].get('allowed_updates') if set_webhook else updates}")
+    print(f"чужой секрет отклонён: {'да' if rejected else 'НЕТ'}")
+    print(f"апдейтов: {args.n}, {args.n / elapsed:.0f}/с")
+    print(f"webhook → ответ: {percentiles(latencies)}")
+
+
+# ==========================
+# Перегрузка: много пользователей одновременно проходят ремонт
+# ==========================
+async def bench_concurrency(args):
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    main = load_bot(api)
+
+    users = [5000 + i for i in range(args.n)]
+    flows = [repair_flow(user_id) for user_id in users]
+    # Шаги пользователей перемешаны, как в реальной очереди
+    raw_updates = [flow[step] for step in range(len(flows[0])) for flow in flows]
+
+    operators = main.OPERATOR_CHAT_ID
+    # Вызовы для клиентов; к операторам — сколько сводок сложится, от прогона к прогону по-разному
+    customer_calls = lambda: sum(1 for _, _, params in api.calls if int(params.get("chat_id", 0)) != operators)
+    reference = None
+    for limit in args.limits:
+        api.calls.clear()
+        main.CONCURRENT_UPDATES = limit
+        app = await start_bot(main)
+        updates = [Update.de_json(data, app.bot) for data in raw_updates]
+        started = time.perf_counter()
+        for update in updates:
+            await app.update_queue.put(update)
+        if reference is None:
+            # Последовательный прогон — эталон порядка ответов
+            await wait_until(lambda: api.count_to(operators) >= len(users), 600)
+            await asyncio.sleep(args.latency * 10 + 0.1)
+        else:
+            await wait_until(lambda: api.count_to(operators) >= len(users) and customer_calls() >= reference[1])
+        elapsed = time.perf_counter() - started
+        await stop_bot(app)
+
+        chats = replies_by_chat(api)
+        if reference is None:
+            reference = (chats, customer_calls())
+        reordered = sum(1 for user_id in users if chats.get(user_id) != reference[0].get(user_id))
+        tickets = api.count_to(operators)
+        print(f"limit={limit:>3}: {len(updates) / elapsed:7.0f} апд/с, "
+              f"заявок у оператора {tickets}/{len(users)}, переставлено у {reordered} польз.")
+    await api.stop()
+
+
+# ==========================
+# Перезапуск посреди заполнения формы
+# ==========================
+async def bench_restart(args):
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    main = load_bot(api)
+    users = [7000 + i for i in range(args.n)]
+    flows = {user_id: repair_flow(user_id) for user_id in users}
+    half = 3  # кнопка, имя, телефон
+
+    async def feed(app, steps):
+        for step in steps:
+            for user_id in users:
+                await app.update_queue.put(Update.de_json(flows[user_id][step], app.bot))
+
+    app = await start_bot(main)
+    await feed(app, range(half))
+    await wait_until(lambda: api.count("sendMessage") >= len(users) * half)
+    await stop_bot(app)
+
+    started = time.perf_counter()
+    app = await start_bot(main, keep_storage=True)
+    startup = time.perf_counter() - started
+    await feed(app, range(half, len(flows[users[0]])))
+    await wait_until(lambda: api.count_to(main.OPERATOR_CHAT_ID) >= len(users), 120)
+    await stop_bot(app)
+    await api.stop()
+
+    tickets = api.notifications(main.OPERATOR_CHAT_ID)
+    complete = sum(1 for user_id in users if any(f"Имя {user_id}\n" in text for text in tickets))
+    print(f"перезапуск с {len(users)} незаконченными формами: {startup * 1000:.1f}ms")
+    print(f"заявок с данными из первой половины формы: {complete}/{len(users)}")
+
+
+# ==========================
+# Память на пользователя: словари user_data против записей со слотами
+# ==========================
+def old_user_data(i: int, values: tuple) -> dict:
+    # Как заполняли user_data до записей со слотами
+    name, phone, kind, brand, model, text = values
+    if i % 3 == 0:
+        return {"mode": "repair", "name": name, "phone": phone, "type": kind,
+                "brand": brand, "model": model, "problem": text, "chat_with_manager": False}
+    if i % 3 == 1:
+        return {"c_name": name, "c_phone": phone, "c_type": kind, "c_brand": brand,
+                "c_model": model, "c_dimensions": text, "c_address": text}
+    return {"chat_with_manager": True}
+
+
+def new_user_data(main, forms: dict, i: int, values: tuple):
+    name, phone, kind, brand, model, text = values
+    data = main.UserData()
+    if i % 3 == 0:
+        data.form = forms["repair"](mode="repair", name=name, phone=phone, type=kind,
+                                    brand=brand, model=model, problem=text)
+    elif i % 3 == 1:
+        data.form = forms["courier"](mode="courier", name=name, phone=phone, type=kind, brand=brand,
+                                     model=model, dimensions=text, address=text)
+    else:
+        data.chat_with_manager = True
+    return data
+
+
+def measure(build) -> tuple:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+
+async def bench_memory(args):
+    api = FakeBotAPI()
+    main = load_bot(api)
+    fresh_storage(main)
+    # Строки одни и те же в обоих вариантах — сравниваем только контейнеры
+    values = ("Имя", "050 123 45 67", "ноутбук", "Lenovo", "IdeaPad 3", "не включается")
+    n = args.n
+
+    old, old_size = measure(lambda: {i: old_user_data(i, values) for i in range(n)})
+    del old
+    app = main.build_app()
+    forms = {flow.kind: flow.form_cls for flow in main.FLOWS}
+    new, new_size = measure(lambda: {i: new_user_data(main, forms, i, values) for i in range(n)})
+
+    # Четыре из пяти пользователей давно молчат — их должен выгрузить сборщик
+    idle_at = time.time() - main.SESSION_IDLE - 1
+    for user_id, data in new.items():
+        if user_id % 5:
+            data.last_seen = idle_at
+    app._user_data.update(new)
+    del new
+    await main.sweep_sessions(SimpleNamespace(application=app))
+    left = len(app.user_data)
+    await app.persistence.flush()
+
+    print(f"пользователей: {n}")
+    print(f"dict user_data:   {old_size / n:6.0f} байт/польз.")
+    print(f"записи со слотами: {new_size / n:6.0f} байт/польз.")
+    print(f"после сборщика простоя осталось {left} из {n}")
+
+
+# ==========================
+# Разбор нажатия кнопки: цепочка регулярок против словаря
+# ==========================
+def regex_handlers(main) -> list:
+    # Обработчики группы 0 в том виде, как они были до CallbackRouter
+    noop = main.cancel
+    text = filters.TEXT & ~filters.COMMAND
+    handlers = [
+        CallbackQueryHandler(noop, pattern=f"^{data}$")
+        for data in ("cancel", "main", "contacts", "social", "manager")
+    ]
+    for flow in main.FLOWS:
+        states = {step.state: [MessageHandler(text, noop)] for step in flow.steps}
+        states[flow.confirm_state] = [CallbackQueryHandler(noop, pattern="^(confirm|cancel)$")]
+        handlers.append(ConversationHandler(
+            entry_points=[CallbackQueryHandler(noop, pattern=f"^{mode}$") for mode in flow.modes],
+            states=states,
+            fallbacks=[CallbackQueryHandler(noop, pattern="^cancel$")],
+        ))
+    handlers.append(MessageHandler(text, noop))
+    handlers.append(CommandHandler("start", noop))
+    return handlers
+
+
+def dispatch_cost(handlers: list, updates: list) -> float:
+    # Как Application ищет обработчик: первый, чей check_update что-то вернул
+    started = time.perf_counter()
+    for update in updates:
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                break
+    return (time.perf_counter() - started) / len(updates)
+
+
+async def bench_router(args):
+    api = FakeBotAPI()
+    main = load_bot(api)
+    fresh_storage(main)
+    app = main.build_app()
+
+    buttons = ["cancel", "main", "contacts", "social", "manager", "repair", "sysadmin", "courier", "cartridge"]
+    updates = [Update.de_json(callback_update(100 + i % 1000, buttons[i % len(buttons)]), app.bot)
+               for i in range(args.n)]
+    old = dispatch_cost(regex_handlers(main), updates)
+    new = dispatch_cost(app.handlers[0], updates)
+
+    print(f"нажатий: {args.n}, кнопки: {', '.join(buttons)}")
+    print(f"регулярки: {old * 1e6:6.2f} мкс на нажатие")
+    print(f"словарь:   {new * 1e6:6.2f} мкс на нажатие")
+
+
+# ==========================
+# Запросы к Bot API и время ответа по каждому сценарию клиента
+# ==========================
+def client_flows(user_id: int) -> dict:
+    return {
+        "/start": [message_update(user_id, "/start")],
+        "контакты → меню": [callback_update(user_id, "contacts"), callback_update(user_id, "main")],
+        "оператор": [callback_update(user_id, "manager"), message_update(user_id, "Здравствуйте")],
+        "ремонт": repair_flow(user_id),
+        "курьер": [
+            callback_update(user_id, "courier"),
+            *(message_update(user_id, text) for text in ("Имя", "050 123 45 67", "ПК", "HP", "ProDesk", "50×40×20", "ул. Ольги, 1")),
+            callback_update(user_id, "attach"),
+            callback_update(user_id, "confirm"),
+        ],
+        "картриджи": [
+            callback_update(user_id, "cartridge"),
+            *(message_update(user_id, text) for text in ("Имя", "050 123 45 67", "Canon", "i-SENSYS MF3010", "725", "ул. Ольги, 1")),
+            callback_update(user_id, "attach"),
+            callback_update(user_id, "confirm"),
+        ],
+        "отмена посреди формы": [
+            callback_update(user_id, "repair"),
+            message_update(user_id, "Имя"),
+            callback_update(user_id, "cancel"),
+        ],
+    }
+
+
+async def bench_roundtrips(args):
+    latency = args.latency or 0.02
+    api = FakeBotAPI(latency=latency)
+    await api.start()
+    main = load_bot(api)
+    app = await start_bot(main)
+    # Один пользователь проходит сценарии подряд без пауз — меряем вызовы, а не лимиты
+    app.bot_data["flood"].clear()
+
+    print(f"задержка Bot API {latency * 1000:.0f}ms, прогонов на сценарий: {args.n}")
+    print(f"{'сценарий':<22}{'апдейтов':>9}{'вызовов':>9}{'мс на сценарий':>16}{'≈ посл. запросов':>18}")
+    for name in client_flows(0):
+        calls = updates = 0
+        spent = []
+        for run in range(args.n):
+            user_id = 9000 + run
+            flow = [Update.de_json(data, app.bot) for data in client_flows(user_id)[name]]
+            for update in flow:
+                before = sum(1 for _, _, p in api.calls if int(p.get("chat_id", user_id)) == user_id)
+                started = time.perf_counter()
+                await app.process_update(update)
+                spent.append(time.perf_counter() - started)
+                # Уведомления операторам уходят из outbox фоном и сюда не входят
+                calls += sum(1 for _, _, p in api.calls if int(p.get("chat_id", user_id)) == user_id) - before
+            updates += len(flow)
+            api.calls.clear()
+        per_flow = sum(spent) / args.n
+        print(f"{name:<22}{updates // args.n:>9}{calls / args.n:>9.1f}{per_flow * 1000:>16.1f}"
+              f"{per_flow / latency:>18.1f}  ({percentiles(spent)} на апдейт)")
+
+    await stop_bot(app)
+    await api.stop()
+
+
+# ==========================
+# Нагрузка: толпа клиентов через getUpdates — с флудом, опечатками,
+# брошенными и отменёнными формами
+# ==========================
+LOAD_ABANDON = 0.15  # бросают форму на полпути
+LOAD_CANCEL = 0.10  # жмут «Отмена» посреди формы
+LOAD_TYPO = 0.10  # сначала вводят телефон с ошибкой
+LOAD_REPEAT = 0.05  # отправляют ту же заявку второй раз
+
+
+# Шаги, после которых оператор должен получить сообщение
+OPERATOR_STEPS = ("form_confirm", "forward_manager")
+
+
+def customer_script(main, rng: random.Random, user_id: int) -> list:
+    # Шаги клиента: [(обработчик, апдейт)]
+    steps = [("main_menu", message_update(user_id, "/start"))]
+    paths = [(flow, mode) for flow in main.FLOWS for mode in flow.modes] + [(None, "manager")]
+    flow, mode = rng.choice(paths)
+    if flow is None:
+        steps.append(("manager_handler", callback_update(user_id, "manager")))
+        steps.append(("forward_manager", message_update(user_id, f"Вопрос от {user_id}")))
+        return steps
+
+    steps.append(("form_start", callback_update(user_id, mode)))
+    answers = []
+    for field in flow.fields:
+        if field.validator is None:
+            answers.append(("form_step", message_update(user_id, f"{field.key} {user_id}")))
+            continue
+        if rng.random() < LOAD_TYPO:
+            answers.append(("form_step", message_update(user_id, "123")))
+        answers.append(("form_step", message_update(user_id, f"050 {user_id:07d}")))
+
+    fate = rng.random()
+    if fate < LOAD_ABANDON:
+        return steps + answers[:rng.randrange(len(answers))]
+    if fate < LOAD_ABANDON + LOAD_CANCEL:
+        return steps + answers[:rng.randrange(len(answers))] + [("cancel", callback_update(user_id, "cancel"))]
+    steps += answers + [("form_attach_done", callback_update(user_id, "attach")),
+                        ("form_confirm", callback_update(user_id, "confirm"))]
+    if rng.random() < LOAD_REPEAT:
+        # Повтор операторам не уходит — обработчик подписан иначе и в ожидаемые не попадает
+        steps += [(f"{handler} (повтор)", data) for handler, data in steps[1:]]
+    return steps
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def bench_load(args):
+    api = FakeBotAPI(latency=args.latency, flood=args.flood, retry_after=args.retry_after, seed=args.seed)
+    await api.start()
+    main = load_bot(api)
+    logging.getLogger("outbox").setLevel(logging.ERROR)
+    rng = random.Random(args.seed)
+    scripts = [customer_script(main, rng, 20000 + i) for i in range(args.n)]
+
+    main.METRICS_PORT = free_port() if args.metrics else 0
+    rss_before = rss_mb()
+    app = await start_bot(main)
+    errors = Counter()
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    app.add_error_handler(count_error)
+    await app.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=main.allowed_updates(app))
+
+    timings = {}  # обработчик -> [время от апдейта до первого ответа]
+    outcome = Counter()
+    expected = 0  # сколько сообщений оператору бот успел получить от клиентов
+
+    async def customer(i: int, steps: list):
+        nonlocal expected
+        user_rng = random.Random(args.seed * 100_003 + i)
+        await asyncio.sleep(user_rng.uniform(0, args.ramp))
+        for handler, data in steps:
+            chat_id = (data.get("message") or data["callback_query"]["message"])["chat"]["id"]
+            replied = api.wait_for_chat(chat_id)
+            started = time.perf_counter()
+            api.push_update(data)
+            expected += handler in OPERATOR_STEPS
+            try:
+                answered = await asyncio.wait_for(replied, args.reply_timeout)
+            except asyncio.TimeoutError:
+                outcome["остались без ответа"] += 1
+                return
+            timings.setdefault(handler, []).append(answered - started)
+            if args.think:
+                await asyncio.sleep(user_rng.uniform(0, 2 * args.think))
+        outcome["дошли до конца сценария"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(customer(i, steps) for i, steps in enumerate(scripts)))
+    elapsed = time.perf_counter() - started
+    await wait_until(lambda: api.count_to(main.OPERATOR_CHAT_ID) >= expected, 30 + args.retry_after * 5)
+    rss_after = rss_mb()
+    scraped = ""
+    if args.metrics:
+        response = await AsyncHTTPClient().fetch(f"http://127.0.0.1:{main.METRICS_PORT}/metrics")
+        scraped = response.body.decode()
+    in_memory = len(app.user_data)
+    open_forms = sum(1 for data in app.user_data.values() if data.form is not None)
+
+    await app.updater.stop()
+    await stop_bot(app)
+    await api.stop()
+
+    answered = sum(len(values) for values in timings.values())
+    operator_texts = api.notifications(main.OPERATOR_CHAT_ID)
+    print(f"клиентов: {args.n}, задержка API {args.latency * 1000:.0f}ms, 429 на {args.flood:.1%} вызовов, "
+          f"CONCURRENT_UPDATES={main.CONCURRENT_UPDATES}")
+    print(f"ответов: {answered} за {elapsed:.1f}с — {answered / elapsed:.0f} апд/с")
+    for name, count in sorted(outcome.items()):
+        print(f"  {name}: {count}")
+    print("время до ответа по обработчикам:")
+    for handler, values in sorted(timings.items()):
+        print(f"  {handler:<24}{len(values):>7}  {percentiles(values)}")
+    print(f"429 от API: {dict(api.flooded) or 'нет'}; ошибок в обработчиках: {dict(errors) or 'нет'}")
+    print(f"оператору: ожидалось {expected}, доставлено {len(operator_texts)}, "
+          f"дублей {len(operator_texts) - len(set(operator_texts))}")
+    print(f"память: RSS {rss_before:.1f} → {rss_after:.1f} МБ (+{rss_after - rss_before:.1f}), "
+          f"сессий в памяти {in_memory}, из них с незаконченной формой {open_forms}")
+    if scraped:
+        # Воронка и ошибки API так, как их увидит Prometheus
+        print(f"/metrics: {len(scraped.splitlines())} строк")
+        for line in scraped.splitlines():
+            if line.startswith(("form_", "bot_api_errors_total", "bot_handler_errors_total")):
+                print(f"  {line}")
+
+
+# ==========================
+# Переписка с операторами: клиенты пишут, операторы отвечают reply — после перезапуска
+# и при маленьком кэше индекс ответов дочитывается с диска
+# ==========================
+def operator_reply(text: str, operator_chat: int, reply_to: int) -> dict:
+    data = message_update(1, text)
+    data["message"]["chat"] = {"id": operator_chat, "type": "supergroup", "title": "Операторы"}
+    data["message"]["reply_to_message"] = {
+        "message_id": reply_to,
+        "date": int(time.time()),
+        "chat": data["message"]["chat"],
+        "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+        "text": "…",
+    }
+    return data
+
+
+def operator_callback(data: str, operator_chat: int) -> dict:
+    update = callback_update(1, data)
+    update["callback_query"]["message"]["chat"] = {"id": operator_chat, "type": "supergroup", "title": "Операторы"}
+    return update
+
+
+async def bench_relay(args):
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    main = load_bot(api)
+    main.RELAY_CACHE = args.relay_cache
+    # Отвечаем reply на каждое сообщение — сводки (там ответ через кнопку) не нужны
+    main.DIGEST_THRESHOLD = 0
+    users = [30000 + i for i in range(args.n)]
+    messages = 3
+
+    app = await start_bot(main)
+    operators = main.OPERATOR_CHAT_ID
+    for user_id in users:
+        await app.update_queue.put(Update.de_json(callback_update(user_id, "manager"), app.bot))
+    for i in range(messages):
+        for user_id in users:
+            await app.update_queue.put(Update.de_json(message_update(user_id, f"Вопрос {i} от {user_id}"), app.bot))
+    await wait_until(lambda: api.count_to(operators) >= len(users) * messages, 120)
+    delivered = api.count_to(operators)
+    await stop_bot(app)
+
+    # Операторы отвечают уже после перезапуска: в памяти индекса пусто
+    app = await start_bot(main, keep_storage=True)
+    relay = app.bot_data["relay"]
+    relayed = [(message_id, text) for chat_id, message_id, text in api.sent if chat_id == operators]
+    lookups = []
+    for message_id, _ in relayed:
+        t0 = time.perf_counter()
+        relay.lookup(message_id)
+        lookups.append(time.perf_counter() - t0)
+    cold = percentiles(lookups)
+    lookups.clear()
+    for message_id, _ in relayed[-min(len(relayed), args.relay_cache):]:
+        t0 = time.perf_counter()
+        relay.lookup(message_id)
+        lookups.append(time.perf_counter() - t0)
+    warm = percentiles(lookups)
+
+    api.calls.clear()
+    for message_id, _ in relayed:
+        await app.process_update(Update.de_json(operator_reply("Ответ оператора", operators, message_id), app.bot))
+    copies = Counter(int(params["chat_id"]) for _, method, params in api.calls if method == "copyMessage")
+    cache_size = len(relay)
+    await stop_bot(app)
+    await api.stop()
+
+    # Каждый ответ должен прийти тому, кто писал это сообщение
+    expected = Counter(int(text.split(" от ")[-1]) for _, text in relayed)
+    print(f"клиентов: {len(users)}, сообщений операторам: {delivered}/{len(users) * messages}")
+    print(f"ответов доставлено клиентам: {sum(copies.values())}, "
+          f"все по адресу: {'да' if copies == expected else 'НЕТ'}")
+    print(f"поиск после перезапуска (с диска): {cold}")
+    print(f"поиск из памяти: {warm}")
+    print(f"в памяти индекса {cache_size} записей (RELAY_CACHE={args.relay_cache})")
+
+
+# ==========================
+# Телефоны: разбор номера и повторные заявки в пике
+# ==========================
+def old_valid_phone(text: str):
+    # Проверка до нормализатора: хранился исходный текст
+    return text if sum(ch.isdigit() for ch in text) >= 9 else None
+
+
+def spell_phone(number: str, rng: random.Random) -> str:
+    # Один и тот же номер так, как его пишут клиенты
+    code, rest = number[:2], number[2:]
+    return rng.choice((
+        f"0{number}",
+        f"+380{number}",
+        f"0{code} {rest[:3]} {rest[3:5]} {rest[5:]}",
+        f"(0{code}) {rest[:3]}-{rest[3:5]}-{rest[5:]}",
+        f"8 0{code} {rest}",
+        f"+38 (0{code}) {rest}",
+    ))
+
+
+async def bench_phones(args):
+    from phones import normalize_phone
+    from tickets import RecentTickets
+    rng = random.Random(args.seed)
+    numbers = [f"{rng.choice('5679')}{rng.randrange(10 ** 8):08d}" for _ in range(max(1, args.n // 10))]
+    texts = [spell_phone(rng.choice(numbers), rng) for _ in range(args.n)]
+    for name, func in (("старая проверка", old_valid_phone), ("normalize_phone", normalize_phone)):
+        started = time.perf_counter()
+        results = [func(text) for text in texts]
+        spent = time.perf_counter() - started
+        print(f"{name:<16} {spent / len(texts) * 1e6:5.2f} мкс на номер, "
+              f"разных номеров у операторов: {len(set(results))} (на самом деле {len(numbers)})")
+
+    # Пик: каждая пятая заявка — повтор одной из недавних, набранный иначе
+    recent = RecentTickets(ttl=600)
+    submitted = []
+    sent = merged = flagged = 0
+    for i in range(args.n):
+        if submitted and rng.random() < 0.2:
+            number, content = rng.choice(submitted[-50:])
+        else:
+            number, content = rng.choice(numbers), i
+            submitted.append((number, content))
+        phone = normalize_phone(spell_phone(number, rng))
+        seen = recent.check(phone, "repair", content)
+        if seen and seen[1]:
+            merged += 1
+            continue
+        sent += 1
+        flagged += seen is not None
+        recent.remember(phone, "repair", content, i)
+    print(f"заявок в пике: {args.n}, операторам ушло {sent} (из них помечено повторным номером {flagged}), "
+          f"не отправлено повторов {merged}, в индексе {len(recent)}")
+
+
+# ==========================
+# Хранилище заявок: поиск и списки на сотнях тысяч заявок
+# ==========================
+def operator_update(text: str, operator_chat: int) -> dict:
+    data = message_update(1, text)
+    data["message"]["chat"] = {"id": operator_chat, "type": "supergroup", "title": "Операторы"}
+    data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return data
+
+
+def fill_tickets(store, n: int, rng: random.Random) -> list:
+    # Заявки за последний год: на телефон в среднем 5 заявок, открыта примерно каждая тридцатая
+    from tickets import STATUSES
+    phones = [f"0{rng.choice('5679')}{rng.randrange(10 ** 8):08d}" for _ in range(max(1, n // 5))]
+    brands = [f"Brand{i}" for i in range(50)]
+    flows = (("repair", "repair"), ("repair", "sysadmin"), ("courier", "courier"), ("cartridge", "cartridge"))
+    started = time.time() - 365 * 86400
+    store.db.execute("BEGIN")
+    for i in range(n):
+        flow, mode = rng.choice(flows)
+        phone, brand = rng.choice(phones), rng.choice(brands)
+        store.add(f"bench:{i}", flow, mode, 1000 + i, phone, brand, {"name": f"Клиент {i}", "brand": brand})
+    store.db.execute("UPDATE tickets SET created_at = ? + id * ?, status = CASE WHEN abs(random()) % 30 = 0 "
+                     "THEN ? ELSE ? END", (started, 365 * 86400 / max(n, 1), STATUSES[0], STATUSES[2]))
+    store.db.execute("COMMIT")
+    return phones
+
+
+async def bench_tickets(args):
+    from tickets import TicketStore
+    api = FakeBotAPI()
+    await api.start()
+    main = load_bot(api)
+    fresh_storage(main)
+    rng = random.Random(args.seed)
+
+    store = TicketStore(main.TICKETS_PATH)
+    started = time.perf_counter()
+    phones = fill_tickets(store, args.n, rng)
+    print(f"заявок: {args.n}, записаны за {time.perf_counter() - started:.1f}с")
+
+    middle = args.n // 2
+    month = time.time() - 30 * 86400
+    queries = {
+        "телефон, 1-я стр.": lambda: store.find_phone(rng.choice(phones), limit=11),
+        "телефон за месяц": lambda: store.find_phone(rng.choice(phones), limit=11, since=month),
+        "бренд, 1-я стр.": lambda: store.find_brand(f"brand{rng.randrange(50)}", limit=11),
+        "бренд, середина": lambda: store.find_brand(f"Brand{rng.randrange(50)}", before=middle, limit=11),
+        "открытые, 1-я стр.": lambda: store.open_tickets(limit=11),
+        "открытые курьер": lambda: store.open_tickets("courier", limit=11),
+        "открытые, середина": lambda: store.open_tickets(before=middle, limit=11),
+        "смена статуса": lambda: store.set_status(rng.randrange(1, args.n + 1), "work"),
+    }
+    for name, query in queries.items():
+        spent = []
+        for _ in range(200):
+            t0 = time.perf_counter()
+            query()
+            spent.append(time.perf_counter() - t0)
+        print(f"  {name:<20} {percentiles(spent)}")
+
+    plans = {
+        "телефон": "SELECT * FROM tickets WHERE phone = ? AND id < ? AND created_at >= ? ORDER BY id DESC LIMIT 11",
+        "бренд": "SELECT * FROM tickets WHERE brand = ? AND id < ? ORDER BY id DESC LIMIT 11",
+        "открытые": "SELECT * FROM tickets INDEXED BY tickets_open WHERE status IN ('new', 'work') AND flow = ? "
+                    "ORDER BY id DESC LIMIT 11",
+    }
+    for name, sql in plans.items():
+        plan = "; ".join(row[3] for row in store.db.execute(f"EXPLAIN QUERY PLAN {sql}", (1,) * sql.count("?")))
+        print(f"  план ({name}): {plan}")
+    store.close()
+
+    # Те же запросы командами из чата операторов
+    app = await start_bot(main, keep_storage=True)
+    operators = main.OPERATOR_CHAT_ID
+    for text in (f"/find {phones[0]}", "/find Brand7 30", "/open courier", "/status 1 done"):
+        replied = api.wait_for_chat(operators)
+        t0 = time.perf_counter()
+        await app.process_update(Update.de_json(operator_update(text, operators), app.bot))
+        await asyncio.wait_for(replied, 5)
+        last = [params for _, method, params in api.calls if method == "sendMessage"][-1]
+        lines = last["text"].count("\n№") + last["text"].startswith("№")
+        paged = "с кнопкой «Дальше»" if last.get("reply_markup") else "без кнопки"
+        print(f"  {text:<24} {(time.perf_counter() - t0) * 1000:6.1f}ms, {lines} заявок, {paged}: "
+              f"{last['text'].splitlines()[0]}")
+    await stop_bot(app)
+    await api.stop()
+
+
+# ==========================
+# Антифлуд: спамеры долбят кнопками, /start и сообщениями операторам, а обычные
+# клиенты в это время заполняют формы — без антифлуда и с ним
+# ==========================
+SPAM_KINDS = ("кнопки", "/start", "операторам")
+SPAM_INTERVAL = 0.02  # скрипт или зажатая кнопка — ~50 апдейтов в секунду от одного
+
+
+def spam_script(user_id: int, kind: str, count: int) -> list:
+    if kind == "кнопки":
+        return [callback_update(user_id, "contacts") for _ in range(count)]
+    if kind == "/start":
+        return [message_update(user_id, "/start") for _ in range(count)]
+    return [callback_update(user_id, "manager")] + [message_update(user_id, f"спам {i}") for i in range(count - 1)]
+
+
+async def bench_antiflood(args):
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    main = load_bot(api)
+    think = args.think or 1.0
+    rng = random.Random(args.seed)
+    # Повторы заявок не берём: живой клиент не заполняет форму дважды за пару секунд
+    scripts = [[step for step in customer_script(main, rng, 40000 + i) if "(повтор)" not in step[0]]
+               for i in range(args.n)]
+    spammers = [(50000 + i, SPAM_KINDS[i % len(SPAM_KINDS)]) for i in range(args.spammers)]
+
+    print(f"клиентов: {args.n} (пауза ~{think}с), спамеров: {args.spammers} по {args.spam} апдейтов, "
+          f"задержка API {args.latency * 1000:.0f}ms")
+    for limited in (False, True):
+        api.calls.clear()
+        app = await start_bot(main)
+        if not limited:
+            app.bot_data["flood"].clear()
+        timings = []
+        unanswered = 0
+
+        spam = {user_id: spam_script(user_id, kind, args.spam) for user_id, kind in spammers}
+        spam_queries = {data["callback_query"]["id"] for script in spam.values()
+                        for data in script if "callback_query" in data}
+
+        async def spammer(user_id: int):
+            for data in spam[user_id]:
+                await app.update_queue.put(Update.de_json(data, app.bot))
+                await asyncio.sleep(SPAM_INTERVAL)
+
+        async def customer(i: int, steps: list):
+            nonlocal unanswered
+            user_rng = random.Random(args.seed * 100_003 + i)
+            await asyncio.sleep(user_rng.uniform(0, args.ramp))
+            for _, data in steps:
+                chat_id = (data.get("message") or data["callback_query"]["message"])["chat"]["id"]
+                replied = api.wait_for_chat(chat_id)
+                started = time.perf_counter()
+                await app.update_queue.put(Update.de_json(data, app.bot))
+                try:
+                    timings.append(await asyncio.wait_for(replied, args.reply_timeout) - started)
+                except asyncio.TimeoutError:
+                    unanswered += 1
+                    return
+                await asyncio.sleep(user_rng.uniform(0, 2 * think))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(spammer(user_id) for user_id in spam),
+                             *(customer(i, steps) for i, steps in enumerate(scripts)))
+        outbox = app.bot_data["outbox"]
+        await wait_until(lambda: app.update_queue.empty() and not outbox.pending_count(), 120)
+        elapsed = time.perf_counter() - started
+        buckets = sum(len(bucket) for bucket in app.bot_data["flood"].values())
+        await stop_bot(app)
+
+        spam_chats = {user_id: kind for user_id, kind in spammers}
+        spent = Counter()
+        for _, method, params in api.calls:
+            chat_id = int(params.get("chat_id", 0))
+            if chat_id in spam_chats:
+                spent[spam_chats[chat_id]] += 1
+            elif params.get("callback_query_id") in spam_queries:
+                spent["кнопки"] += 1
+        to_operators = api.notifications(main.OPERATOR_CHAT_ID)
+        from_spam = sum(1 for text in to_operators if "спам" in text)
+        print(f"\n{'с антифлудом' if limited else 'без антифлуда'} ({elapsed:.1f}с):")
+        print(f"  вызовов Bot API на спамеров: {sum(spent.values())} из {len(api.calls)} "
+              f"({', '.join(f'{kind} {spent[kind]}' for kind in SPAM_KINDS)})")
+        print(f"  уведомлений операторам: {len(to_operators)}, из них спама {from_spam}")
+        print(f"  клиенты: ответов {len(timings)}, без ответа {unanswered}, {percentiles(timings)}")
+        if limited:
+            print(f"  вёдер в памяти: {buckets}")
+    await api.stop()
+
+
+# ==========================
+# Сводки операторам: наплыв заявок и сообщений при лимите чата операторов
+# (--chat-interval 0.3 — это 3 секунды Telegram, ускоренные в 10 раз)
+# ==========================
+def campaign_customer(user_id: int) -> tuple:
+    # (апдейты до наплыва, апдейт в наплыв, метка в тексте у операторов)
+    if user_id % 2:
+        marker = f"Вопрос от {user_id}"
+        return [callback_update(user_id, "manager")], message_update(user_id, marker), marker
+    marker = f"Клиент {user_id}"
+    answers = (marker, f"050 {user_id:07d}", "ПК", "HP", "ProDesk", "50×40×20", "ул. Ольги, 1")
+    prepare = [callback_update(user_id, "courier"), *(message_update(user_id, text) for text in answers),
+               callback_update(user_id, "attach")]
+    return prepare, callback_update(user_id, "confirm"), marker
+
+
+async def bench_digest(args):
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    main = load_bot(api)
+    main.OUTBOX_CHAT_INTERVAL = args.chat_interval
+    operators = main.OPERATOR_CHAT_ID
+    customers = [campaign_customer(60000 + i) for i in range(args.n)]
+    threshold = main.DIGEST_THRESHOLD or 3
+
+    print(f"клиентов: {args.n} за {args.ramp}с, пауза чата операторов {args.chat_interval}с")
+    for digest in (0, threshold):
+        main.DIGEST_THRESHOLD = digest
+        api.calls.clear()
+        api.sent.clear()
+        app = await start_bot(main)
+        app.bot_data["flood"].clear()
+        for prepare, _, _ in customers:
+            for data in prepare:
+                await app.process_update(Update.de_json(data, app.bot))
+
+        arrived = {}
+        started = time.perf_counter()
+
+        async def customer(i: int, data: dict, marker: str):
+            await asyncio.sleep(args.ramp * i / len(customers))
+            arrived[marker] = time.perf_counter()
+            await app.process_update(Update.de_json(data, app.bot))
+
+        await asyncio.gather(*(customer(i, data, marker) for i, (_, data, marker) in enumerate(customers)))
+        outbox = app.bot_data["outbox"]
+        await wait_until(lambda: not outbox.pending_count(), 300)
+        elapsed = time.perf_counter() - started
+
+        delivered = {}
+        messages = [(at, params) for at, method, params in api.calls
+                    if method == "sendMessage" and int(params["chat_id"]) == operators]
+        for at, params in messages:
+            for marker in arrived:
+                if marker in params["text"]:
+                    delivered.setdefault(marker, at)
+        waits = [delivered[marker] - arrived[marker] for marker in arrived if marker in delivered]
+        digests = sum(1 for _, params in messages if params.get("reply_markup"))
+        print(f"\n{'сводки с ' + str(digest) if digest else 'по одному'} ({elapsed:.1f}с):")
+        print(f"  сообщений операторам: {len(messages)} (сводок {digests}), дошло {len(delivered)}/{len(arrived)}")
+        print(f"  от клиента до операторов: {percentiles(waits)}")
+
+        if digests:
+            # Кнопки сводки: «в работу» и «ответить» через запрос ответа
+            markup = next(params["reply_markup"] for _, params in messages if params.get("reply_markup"))
+            buttons = [button["callback_data"] for row in markup["inline_keyboard"] for button in row]
+            status = next(data for data in buttons if data.startswith("status:"))
+            reply = next(data for data in buttons if data.startswith("reply:"))
+            await app.process_update(Update.de_json(operator_callback(status, operators), app.bot))
+            ticket = app.bot_data["tickets"].get(int(status.split(":")[1]))
+            await app.process_update(Update.de_json(operator_callback(reply, operators), app.bot))
+            prompt = api.sent[-1][1]
+            await app.process_update(Update.de_json(operator_reply("Ответ из сводки", operators, prompt), app.bot))
+            copied = [params for _, method, params in api.calls if method == "copyMessage"]
+            print(f"  кнопка «в работу»: {'да' if ticket['status'] == 'work' else 'НЕТ'}, "
+                  f"ответ по кнопке дошёл клиенту: {'да' if copied and copied[-1]['chat_id'] == int(reply.split(':')[1]) else 'НЕТ'}")
+        await stop_bot(app)
+    await api.stop()
+
+
+# ==========================
+# Вложения к заявкам: альбом и документ уходят операторам по file_id
+# ==========================
+async def bench_attachments(args):
+    api = FakeBotAPI(latency=args.latency, flood=args.flood, retry_after=args.retry_after, seed=args.seed,
+                     flood_methods=MEDIA_METHODS)
+    await api.start()
+    main = load_bot(api)
+    app = await start_bot(main)
+    app.bot_data["flood"].clear()
+    operators = main.OPERATOR_CHAT_ID
+    users = [70000 + i for i in range(args.n)]
+    acks = []  # от последнего файла до ответа клиенту
+
+    async def customer(user_id: int):
+        form = [Update.de_json(data, app.bot) for data in repair_flow(user_id)]
+        for update in form[:-2]:
+            await app.process_update(update)
+        # Альбом и документ следом — как их присылает Telegram, отдельными апдейтами
+        files = [media_update(user_id, "photo", f"photo{user_id}_{i}", f"album{user_id}") for i in range(args.album)]
+        files.append(media_update(user_id, "document", f"doc{user_id}"))
+        acked = api.wait_for_chat(user_id)
+        for data in files:
+            await app.process_update(Update.de_json(data, app.bot))
+        sent = time.perf_counter()
+        acks.append(await asyncio.wait_for(acked, 30) - sent)
+        for update in form[-2:]:
+            await app.process_update(update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(customer(user_id) for user_id in users))
+    outbox = app.bot_data["outbox"]
+    await wait_until(lambda: not outbox.pending_count(), 120)
+    elapsed = time.perf_counter() - started
+    await stop_bot(app)
+    await api.stop()
+
+    replies = replies_by_chat(api)
+    acked = [sum(1 for text in replies.get(user_id, ()) if text.startswith("📎 Получено файлов")) for user_id in users]
+    albums = [params for _, method, params in api.calls if method == "sendMediaGroup"]
+    documents = [params for _, method, params in api.calls if method == "sendDocument"]
+    expected = {f"photo{user_id}_{i}-1280" for user_id in users for i in range(args.album)}
+    photos = {item["media"] for params in albums for item in params["media"]}
+    tickets = [text for text in api.notifications(operators) if "📎 Вложения:" in text]
+    media_bytes = sum(api.received[method] for method in ("sendMediaGroup", "sendDocument", "sendPhoto"))
+    files = args.n * (args.album + 1)
+    print(f"клиентов: {args.n}, у каждого альбом из {args.album} фото и документ 20 МБ ({elapsed:.1f}с)")
+    print(f"ответов «получено» на клиента: {Counter(acked)}, "
+          f"через {percentiles(acks)} после последнего файла (ATTACH_DEBOUNCE={main.ATTACH_DEBOUNCE}с)")
+    print(f"операторам: заявок с вложениями {len(tickets)}, альбомов {len(albums)}, документов {len(documents)}; "
+          f"фото по file_id самого большого размера: {'да' if photos == expected else 'НЕТ'}")
+    print(f"в Bot API ушло {media_bytes / files:.0f} байт на файл; скачано файлов: {api.count('getFile')}")
+    print(f"429 от API: {dict(api.flooded) or 'нет'}; заявок дошло операторам: {len(tickets)} из {args.n}")
+
+
+# ==========================
+# Подсказки: индекс на десятки тысяч моделей — память, поиск по префиксу,
+# добавление по одному и старт из заявок в базе
+# ==========================
+SUGGEST_SERIES = ("LaserJet", "i-SENSYS", "ECOSYS", "IdeaPad", "ThinkPad", "VivoBook", "Aspire", "Inspiron",
+                  "Pavilion", "WorkCentre", "Phaser", "Xpress", "PIXMA", "Latitude", "Vostro", "Swift")
+
+
+def synthetic_models(n: int, rng: random.Random) -> list:
+    # (бренд, модель): серия, номер и суффикс — как «LaserJet Pro M404dn»
+    models = set()
+    while len(models) < n:
+        brand = f"Brand{rng.randrange(50)}"
+        model = f"{rng.choice(SUGGEST_SERIES)} {rng.choice('MPGLX')}{rng.randrange(10000)}{rng.choice(('', 'dn', 'dw', 'a'))}"
+        models.add((brand, model))
+    return sorted(models)
+
+
+async def bench_suggest(args):
+    from suggest import Suggestions, normalize
+    from tickets import TicketStore
+    api = FakeBotAPI()
+    main = load_bot(api)
+    fresh_storage(main)
+    rng = random.Random(args.seed)
+    models = synthetic_models(args.n, rng)
+
+    def build():
+        suggestions = Suggestions()
+        for brand, model in models:
+            suggestions.learn("model", model, brand)
+        for brand in ("", *{brand for brand, _ in models}):  # сортировка накопленных ключей
+            suggestions.search("model", "", brand, fallback=False)
+        return suggestions
+
+    started = time.perf_counter()
+    build()
+    built = time.perf_counter() - started
+    suggestions, size = measure(build)
+    print(f"моделей: {len(models)}, индекс построен за {built:.2f}с, "
+          f"в памяти {size / 2 ** 20:.1f} МБ ({size / len(models):.0f} байт на модель)")
+
+    # Что было бы без индекса: проход по всем моделям на каждый ввод
+    names = [model for _, model in models]
+
+    def scan(prefix):
+        prefix = normalize(prefix)
+        return [name for name in names if any(word.startswith(prefix) for word in normalize(name).split())][:6]
+
+    words = [model.split()[-1] for _, model in models]
+    for length in (1, 2, 3, 5):
+        prefixes = [rng.choice(words)[:length] for _ in range(500)]
+        spent = []
+        for prefix in prefixes:
+            t0 = time.perf_counter()
+            suggestions.search("model", prefix, limit=6)
+            spent.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        for prefix in prefixes[:20]:
+            scan(prefix)
+        linear = (time.perf_counter() - t0) / 20
+        print(f"  префикс {length} симв.: {percentiles(spent)}; перебором {linear * 1000:.1f}ms")
+    spent = []
+    for brand, model in rng.sample(models, 200):
+        t0 = time.perf_counter()
+        suggestions.search("model", model.split()[-1][:2], brand, limit=6)
+        spent.append(time.perf_counter() - t0)
+    print(f"  модели бренда, 2 симв.: {percentiles(spent)}")
+
+    # Новая заявка — добавление по одному, без перестройки
+    extra = synthetic_models(args.n + 1000, random.Random(args.seed + 1))[:1000]
+    spent = []
+    for brand, model in extra:
+        t0 = time.perf_counter()
+        suggestions.learn("model", f"{model} new", brand)
+        spent.append(time.perf_counter() - t0)
+    print(f"  добавление модели: {percentiles(spent)}")
+
+    # Старт бота: каталог + счётчики по заявкам из базы
+    store = TicketStore(main.TICKETS_PATH)
+    store.db.execute("BEGIN")
+    for i in range(args.n * 2):
+        brand, model = rng.choice(models)
+        store.add(f"bench:{i}", "repair", "repair", 1000 + i, "0501234567", brand,
+                  {"name": f"Клиент {i}", "type": "Ноутбук", "brand": brand, "model": model})
+    store.db.execute("COMMIT")
+    started = time.perf_counter()
+    main.build_suggestions(store)
+    print(f"старт из {args.n * 2} заявок и каталога: {(time.perf_counter() - started) * 1000:.0f}ms")
+    store.close()
+
+
+# ==========================
+# Несколько процессов-обработчиков: пропускная способность от их числа и
+# переезд пользователей посреди формы при смене числа обработчиков
+# ==========================
+def shard_flow(user_id: int) -> list:
+    # Бренд и модель у каждого свои и не начало чужих — подсказки не вмешиваются
+    return [
+        callback_update(user_id, "repair"),
+        message_update(user_id, f"Имя {user_id}"),
+        message_update(user_id, "050 123 45 67"),
+        message_update(user_id, "ноутбук"),
+        message_update(user_id, f"Бренд {user_id:07d}"),
+        message_update(user_id, f"Модель {user_id:07d}"),
+        message_update(user_id, "не включается"),
+        callback_update(user_id, "attach"),
+        callback_update(user_id, "confirm"),
+    ]
+
+
+def shard_storage(main) -> str:
+    # Обработчики — отдельные процессы: пути к базам им передаются через окружение
+    root = fresh_storage(main)
+    for name in ("OUTBOX_PATH", "PERSISTENCE_PATH", "TICKETS_PATH", "RELAY_PATH"):
+        os.environ[name] = getattr(main, name)
+    return root
+
+
+async def wait_tickets(path: str, count: int, timeout: float = 120.0) -> list:
+    import sqlite3
+    db = sqlite3.connect(path)
+    deadline = time.perf_counter() + timeout
+    try:
+        while time.perf_counter() < deadline:
+            try:
+                rows = db.execute("SELECT user_id, data FROM tickets").fetchall()
+            except sqlite3.OperationalError:
+                rows = []
+            if len(rows) >= count:
+                return rows
+            await asyncio.sleep(0.02)
+        return rows
+    finally:
+        db.close()
+
+
+def complete_tickets(rows: list) -> int:
+    # Заявка собрана одним процессом от начала до конца — все поля на своих местах
+    complete = 0
+    for user_id, data in rows:
+        data = json.loads(data)
+        if (data.get("name") == f"Имя {user_id}" and data.get("brand") == f"Бренд {user_id:07d}"
+                and data.get("model") == f"Модель {user_id:07d}"):
+            complete += 1
+    return complete
+
+
+def crash_shard(shard: int, count: int, updates, ready):
+    # Обработчик, падающий при запуске (нет базы, ошибка в настройках)
+    sys.exit(3)
+
+
+async def bench_shards(args):
+    import shards
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    main = load_bot(api)
+    os.environ["OUTBOX_POLL"] = "0.1"
+    operators = main.OPERATOR_CHAT_ID
+    print(f"ядер: {os.cpu_count()}, клиентов: {args.n}, апдейтов на клиента: {len(shard_flow(0))}")
+
+    # Сколько стоит приёмнику разложить апдейт
+    ring = shards.HashRing(max(args.shards))
+    sample = [upd for i in range(1000) for upd in shard_flow(40000 + i)]
+    t0 = time.perf_counter()
+    for data in sample:
+        ring.node(shards.update_user(data))
+    print(f"приёмник: {(time.perf_counter() - t0) / len(sample) * 1e6:.1f} мкс на апдейт (ключ + кольцо)")
+
+    base = None
+    for count in args.shards:
+        shard_storage(main)
+        api.calls.clear()
+        ingress = shards.Ingress(main.run_shard)
+        await ingress.start(count)
+        users = range(50000, 50000 + args.n)
+        updates = [upd for user_id in users for upd in shard_flow(user_id)]
+        started = time.perf_counter()
+        ingress.route(updates)
+        rows = await wait_tickets(main.TICKETS_PATH, args.n)
+        elapsed = time.perf_counter() - started
+        deadline = time.perf_counter() + 10
+        while api.count_to(operators) < len(rows) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        await ingress.stop()
+        rate = len(updates) / elapsed
+        base = base or rate
+        spread = Counter(ring_node for ring_node in map(ingress.ring.node, users))
+        print(f"обработчиков {count}: {rate:6.0f} апд/с (×{rate / base:.2f}), заявок {complete_tickets(rows)}/{args.n}, "
+              f"операторам {api.count_to(operators)}/{args.n}, клиентов по обработчикам {sorted(spread.values())}")
+
+    # Половина формы при одном числе обработчиков, остальное — при другом
+    count = args.shards[0]
+    shard_storage(main)
+    ingress = shards.Ingress(main.run_shard)
+    await ingress.start(count)
+    users = range(60000, 60000 + args.n)
+    flows = {user_id: shard_flow(user_id) for user_id in users}
+    ingress.route([upd for flow in flows.values() for upd in flow[:4]])
+    old = ingress.ring
+    t0 = time.perf_counter()
+    await ingress.resize(count + 1)
+    pause = time.perf_counter() - t0
+    moved = sum(old.node(user_id) != ingress.ring.node(user_id) for user_id in users)
+    ingress.route([upd for flow in flows.values() for upd in flow[4:]])
+    rows = await wait_tickets(main.TICKETS_PATH, args.n)
+    await ingress.stop()
+    print(f"{count} → {count + 1} обработчиков посреди формы: пауза {pause:.1f}с, переехало {moved}/{args.n} клиентов, "
+          f"заявок собрано целиком {complete_tickets(rows)}/{args.n}")
+
+    # Обработчик убит: его апдейты копятся в очереди, надзор поднимает его заново
+    count = max(2, args.shards[0])
+    shard_storage(main)
+    ingress = shards.Ingress(main.run_shard)
+    await ingress.start(count)
+    supervising = asyncio.create_task(ingress.supervise())
+    victim = ingress._workers[-1]
+    victim.kill()
+    t0 = time.perf_counter()
+    users = range(70000, 70000 + args.n)
+    ingress.route([upd for user_id in users for upd in shard_flow(user_id)])
+    rows = await wait_tickets(main.TICKETS_PATH, args.n)
+    restored = time.perf_counter() - t0
+    supervising.cancel()
+    async with ingress._lock:
+        await ingress.stop()
+    print(f"{victim.name} убит: заявок {complete_tickets(rows)}/{args.n} через {restored:.1f}с")
+
+    ingress = shards.Ingress(crash_shard)
+    t0 = time.perf_counter()
+    try:
+        await ingress.start(2)
+        print("упавший при запуске обработчик: приёмник ЖДЁТ")
+    except RuntimeError as exc:
+        print(f"упавший при запуске обработчик: ошибка через {time.perf_counter() - t0:.1f}с ({exc})")
+    await api.stop()
+
+
+# ==========================
+# Статистика: отчёт из счётчиков против пересчёта по заявкам, запись заявки
+# со счётчиком и выгрузка всей истории
+# ==========================
+async def bench_stats(args):
+    import stats
+    from tickets import TicketStore
+    api = FakeBotAPI()
+    main = load_bot(api)
+    fresh_storage(main)
+    rng = random.Random(args.seed)
+
+    store = TicketStore(main.TICKETS_PATH)
+    started = time.perf_counter()
+    fill_tickets(store, args.n, rng)
+    print(f"заявок: {args.n}, записаны за {time.perf_counter() - started:.1f}с, "
+          f"счётчики по дням пересчитаны за {timed(store.stats.backfill):.2f}с")
+
+    spent = []
+    for i in range(1000):
+        t0 = time.perf_counter()
+        store.add(f"stats:{i}", "repair", "repair", 1, "0501234567", f"Brand{i % 50}", {"name": "Клиент"})
+        spent.append(time.perf_counter() - t0)
+    print(f"  запись заявки со счётчиком: {percentiles(spent)}")
+    spent = []
+    for i in range(1000):
+        t0 = time.perf_counter()
+        store.count("courier", f"Brand{i % 50}", "cancelled", "phone")
+        spent.append(time.perf_counter() - t0)
+    print(f"  брошенная форма:           {percentiles(spent)}")
+
+    for days in (7, 365):
+        since = time.time() - (days - 1) * 86400
+        report = timed(lambda: main.stats_text(store.stats, days, since))
+        rescan = timed(lambda: store.db.execute(
+            "SELECT mode, brand, date(created_at, 'unixepoch', 'localtime'), COUNT(*) FROM tickets"
+            " WHERE created_at >= ? GROUP BY 1, 2, 3", (since,)).fetchall())
+        print(f"  /stats за {days} дн.: {report * 1000:.1f}ms из счётчиков, {rescan * 1000:.1f}ms пересчётом по заявкам")
+
+    # Выгрузка генератором против выгрузки списком — пиковая память
+    with open(os.devnull, "w") as out:
+        for name, rows in (("генератор", lambda: stats.ticket_rows(store.db)),
+                           ("список", lambda: list(stats.ticket_rows(store.db)))):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            stats.write_csv(rows(), stats.TICKET_COLUMNS, out)
+            elapsed = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"  выгрузка CSV ({name}): {elapsed:.1f}с, пик памяти {peak / 2 ** 20:.1f} МБ")
+    store.close()
+
+
+def timed(call) -> float:
+    t0 = time.perf_counter()
+    call()
+    return time.perf_counter() - t0
+
+
+SCENARIOS = {
+    "stats": bench_stats,
+    "shards": bench_shards,
+    "suggest": bench_suggest,
+    "attachments": bench_attachments,
+    "digest": bench_digest,
+    "antiflood": bench_antiflood,
+    "concurrency": bench_concurrency,
+    "load": bench_load,
+    "roundtrips": bench_roundtrips,
+    "tickets": bench_tickets,
+    "phones": bench_phones,
+    "relay": bench_relay,
+    "router": bench_router,
+    "memory": bench_memory,
+    "restart": bench_restart,
+    "webhook": bench_webhook,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("-n", type=int, default=None, help="число пользователей/апдейтов")
+    parser.add_argument("--limits", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="значения CONCURRENT_UPDATES для concurrency")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка поддельного Bot API, с")
+    parser.add_argument("--flood", type=float, default=0.0, help="доля вызовов, на которые API отвечает 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза клиента между шагами, с")
+    parser.add_argument("--ramp", type=float, default=1.0, help="за сколько секунд приходят все клиенты (load)")
+    parser.add_argument("--reply-timeout", type=float, default=10.0, help="сколько клиент ждёт ответа (load)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--relay-cache", type=int, default=100, help="RELAY_CACHE для relay")
+    parser.add_argument("--spammers", type=int, default=9, help="число спамеров (antiflood)")
+    parser.add_argument("--spam", type=int, default=300, help="апдейтов от каждого спамера (antiflood)")
+    parser.add_argument("--chat-interval", type=float, default=0.3, help="OUTBOX_CHAT_INTERVAL для digest")
+    parser.add_argument("--album", type=int, default=5, help="фото в альбоме (attachments)")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="числа обработчиков (shards)")
+    parser.add_argument("--metrics", action="store_true", help="включить метрики и показать воронку (load)")
+    args = parser.parse_args()
+    if args.n is None:
+        args.n = {"memory": 100_000, "router": 100_000, "roundtrips": 20, "load": 300, "tickets": 300_000, "phones": 100_000, "relay": 300, "antiflood": 100, "digest": 100, "attachments": 50, "suggest": 50_000, "shards": 300, "stats": 300_000}.get(args.scenario, 500)
+    asyncio.run(SCENARIOS[args.scenario](args))
@@ -0,0 +1,126 @@
+# ==========================
+# Формы заявок: описание полей → таблица состояний
+#
+# Каждая услуга описывается списком полей. При запуске описание один раз
+# превращается в шаги ConversationHandler (номер состояния → шаг), класс
+# записи со слотами и шаблон итогового текста, так что на каждом сообщении
+# остаётся только проверить ввод и перейти к следующему шагу.
+# ==========================
+import operator
+
+from sessions import EMPTY, FORMS, Form
+
+NOT_SPECIFIED = "не указано"
+CONFIRM_STEP = "confirm"  # имя шага подтверждения в метриках воронки
+ATTACH_STEP = "attach"  # шаг вложений после полей, если он есть у услуги
+
+
+class Field:
+    __slots__ = ("key", "label", "prompt", "required", "validator", "error", "default", "suggest")
+
+    def __init__(self, key: str, label: str, prompt: str, required: bool = False,
+                 validator=None, error: str = "", default: str = NOT_SPECIFIED, suggest: str = None):
+        self.key = key
+        self.label = label  # подпись в итоговом тексте
+        self.prompt = prompt
+        self.required = required
+        self.validator = validator  # text -> значение или None, если ввод не подходит
+        self.error = error
+        self.default = default  # для необязательных полей, оставленных пустыми
+        self.suggest = suggest  # вид подсказок (suggest.py): type, brand, model, cartridge
+
+    def clean(self, text: str):
+        text = text.strip()
+        if not text:
+            return None if self.required else self.default
+        return self.validator(text) if self.validator else text
+
+
+class Step:
+    __slots__ = ("flow", "state", "field", "next_state", "next_key", "next_prompt", "next_field")
+
+    def __init__(self, flow, state, field, next_state, next_key, next_prompt, next_field=None):
+        self.flow = flow
+        self.state = state
+        self.field = field
+        self.next_state = next_state
+        self.next_key = next_key  # поле следующего шага, ATTACH_STEP или CONFIRM_STEP
+        self.next_prompt = next_prompt  # None — это последнее поле, дальше подтверждение
+        self.next_field = next_field  # Field следующего шага, если дальше поле
+
+
+class Flow:
+    def __init__(self, kind: str, first_state: int, modes: dict, fields: list, done: str, cancelled: str,
+                 attach_prompt: str = None):
+        # modes: callback_data кнопки → (заголовок при старте, заголовок заявки)
+        # attach_prompt: после полей — необязательный шаг с фото и документами
+        self.kind = kind
+        self.fields = tuple(fields)
+        self.done = done
+        self.cancelled = cancelled
+        self.attach_prompt = attach_prompt
+
+        keys = tuple(field.key for field in self.fields)
+        slots = ("mode", *keys, "attachments", "summary")
+        self.form_cls = type(f"{kind.title()}Form", (Form,), {"__slots__": slots, "kind": kind})
+        FORMS[kind] = self.form_cls
+
+        self.first_state = first_state
+        self.confirm_state = first_state + len(self.fields)
+        # Номер после подтверждения: у сохранённых диалогов прежние номера состояний не сдвигаются
+        self.attach_state = self.confirm_state + 1 if attach_prompt else None
+        last = (ATTACH_STEP, self.attach_state, attach_prompt) if attach_prompt else (CONFIRM_STEP, self.confirm_state, None)
+        self.steps = tuple(
+            Step(
+                self,
+                first_state + i,
+                field,
+                first_state + i + 1 if i + 1 < len(self.fields) else last[1],
+                self.fields[i + 1].key if i + 1 < len(self.fields) else last[0],
+                self.fields[i + 1].prompt if i + 1 < len(self.fields) else last[2],
+                self.fields[i + 1] if i + 1 < len(self.fields) else None,
+            )
+            for i, field in enumerate(self.fields)
+        )
+
+        first_prompt = self.fields[0].prompt
+        self.intros = {mode: f"{heading}\n\n{first_prompt}" for mode, (heading, _) in modes.items()}
+        self.titles = {mode: title for mode, (_, title) in modes.items()}
+        self._values = operator.attrgetter(*keys)
+        self._template = "\n".join(f"{field.label}: {{}}" for field in self.fields)
+
+    @property
+    def modes(self):
+        return self.intros.keys()
+
+    def new_form(self, mode: str) -> Form:
+        return self.form_cls(mode=mode, attachments=[])
+
+    def position(self, form) -> str:
+        # На каком шаге форма: первое незаполненное поле (поля заполняются по порядку)
+        for field in self.fields:
+            if getattr(form, field.key) == EMPTY:
+                return field.key
+        if self.attach_prompt and form.summary == EMPTY:
+            return ATTACH_STEP
+        return CONFIRM_STEP
+
+    @staticmethod
+    def attachments(form) -> list:
+        # [[вид, file_id], ...]; у форм, сохранённых до появления вложений, — пусто
+        return form.attachments if isinstance(form.attachments, list) else []
+
+    def render(self, form) -> str:
+        text = self._template.format(*self._values(form))
+        attachments = self.attachments(form)
+        if attachments:
+            text += f"\n📎 Вложения: {len(attachments)}"
+        return text
+
+    def summary(self, form) -> str:
+        # Клиенту перед подтверждением
+        return f"{self.titles[form.mode]}\n\n{form.summary}\n\nВсё верно?"
+
+    def ticket(self, form, ticket_id: int) -> str:
+        # Операторам; номер — для поиска и смены статуса
+        return f"{self.titles[form.mode]} №{ticket_id}\n{form.summary}"
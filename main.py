@@ -1,17 +1,40 @@
+import asyncio
+import functools
+import json
 import logging
 import re
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import time
+from telegram import Update, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     filters,
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
 )
 
+from antiflood import TokenBucket
+from outbox import ALBUM_LIMIT, CAPTION_LIMIT, COPY, Outbox, OutboxSender, media_groups
+from phones import normalize_phone
+from relay import RelayIndex
+from persistence import SQLitePersistence
+from metrics import MeteredRequest, Metrics, NullMetrics, SamplingProfiler
+from replies import KeepAliveRequest, Replies
+from router import CallbackRouter
+from forms import ATTACH_STEP, CONFIRM_STEP, NOT_SPECIFIED, Field, Flow, Step
+from sessions import EMPTY, UserData
+import shards
+from suggest import Suggestions
+from stats import day_of
+from tickets import STATUSES, RecentTickets, TicketStore
+
 # ==========================
 # Настройки
 # ==========================
@@ -20,57 +43,240 @@ OPERATOR_CHAT_ID = int(os.getenv("OPERATOR_CHAT_ID", "0"))
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не задан в переменных окружения!")
 
+# Адрес Bot API (можно указать локальный Bot API server)
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+
+# Режим приёма апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, который видит Telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")  # слушаем за локальным reverse proxy
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Число процессов-обработчиков: больше 1 — этот процесс только принимает апдейты и раздаёт
+# их обработчикам по пользователю (shards.py); 1 — всё в одном процессе
+SHARDS = int(os.getenv("SHARDS", "1"))
+# Очередь входящих апдейтов и число апдейтов в обработке ограничены (по UPDATE_QUEUE_SIZE):
+# при переполнении приём ждёт, а не раздувает память
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Сколько апдейтов разных пользователей обрабатываем одновременно (1 — строго по одному)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+
+# Соединения с Bot API: пул под CONCURRENT_UPDATES обработчиков (у каждого до двух
+# одновременных вызовов) плюс отправщик outbox; простаивающие соединения держим открытыми
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", str(CONCURRENT_UPDATES * 2 + 4)))
+BOT_API_KEEPALIVE = float(os.getenv("BOT_API_KEEPALIVE", "60"))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "5"))
+
+# Очередь уведомлений операторам (SQLite) и темп отправки в чат операторов
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.db")
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", "3"))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+# Если к отправке в чат операторов накопилось DIGEST_THRESHOLD уведомлений и больше,
+# они уходят одной сводкой до DIGEST_SIZE штук (0 — всегда по одному)
+DIGEST_THRESHOLD = int(os.getenv("DIGEST_THRESHOLD", "3"))
+DIGEST_SIZE = int(os.getenv("DIGEST_SIZE", "10"))
+# При SHARDS > 1 в outbox пишут все обработчики, а отправляет №0: так часто он заглядывает в очередь, с
+OUTBOX_POLL = float(os.getenv("OUTBOX_POLL", "0.5"))
+
+# Ответы операторов клиентам: message_id в чате операторов → чат клиента.
+# В памяти последние RELAY_CACHE записей, на диске — за RELAY_TTL_DAYS дней
+RELAY_PATH = os.getenv("RELAY_PATH", "relay.db")
+RELAY_CACHE = int(os.getenv("RELAY_CACHE", "10000"))
+RELAY_TTL_DAYS = float(os.getenv("RELAY_TTL_DAYS", "30"))
+
+# Все подтверждённые заявки (поиск и статусы для операторов); по сколько показывать в списках
+TICKETS_PATH = os.getenv("TICKETS_PATH", "tickets.db")
+TICKETS_PAGE = int(os.getenv("TICKETS_PAGE", "10"))
+# Повтор той же заявки с того же номера в течение DEDUP_WINDOW секунд операторам не отправляется (0 — выключено)
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "600"))
+
+# Диалоги и user_data переживают перезапуск; пишутся пачками раз в PERSISTENCE_INTERVAL секунд
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "sessions.db")
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+
+# Подсказки типа, бренда и моделей: каталог для старта (дальше учатся на заявках) и сколько
+# кнопок показывать (0 — без подсказок)
+SUGGEST_CATALOG = os.getenv("SUGGEST_CATALOG", "catalog.json")
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", "6"))
+
+# Фото и документы к заявке: альбом приходит отдельными апдейтами — отвечаем, когда
+# ATTACH_DEBOUNCE секунд не было новых файлов
+ATTACH_DEBOUNCE = float(os.getenv("ATTACH_DEBOUNCE", "1.5"))
+
+# Незаконченные формы и флаг «пишу оператору» живут не дольше SESSION_IDLE секунд простоя
+CONVERSATION_TIMEOUT = 900
+SESSION_IDLE = float(os.getenv("SESSION_IDLE", str(CONVERSATION_TIMEOUT * 2)))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+
+# Антифлуд на пользователя: BURST апдейтов подряд, дальше RATE в секунду (RATE 0 — без ограничения).
+# Отдельно кнопки, сообщения боту и сообщения операторам (чат операторов — ~20 в минуту на всех)
+FLOOD_CALLBACK_RATE = float(os.getenv("FLOOD_CALLBACK_RATE", "1"))
+FLOOD_CALLBACK_BURST = int(os.getenv("FLOOD_CALLBACK_BURST", "10"))
+FLOOD_MESSAGE_RATE = float(os.getenv("FLOOD_MESSAGE_RATE", "0.5"))
+FLOOD_MESSAGE_BURST = int(os.getenv("FLOOD_MESSAGE_BURST", "10"))
+FLOOD_FORWARD_RATE = float(os.getenv("FLOOD_FORWARD_RATE", "0.1"))
+FLOOD_FORWARD_BURST = int(os.getenv("FLOOD_FORWARD_BURST", "5"))
+
+# Метрики Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics (0 — выключены)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+# Выборочный профилировщик event loop: шаг в секундах (0 — выключен); работает вместе с метриками
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0"))
+PROFILE_PATH = os.getenv("PROFILE_PATH", "profile.folded")
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"Неизвестный BOT_MODE: {BOT_MODE}")
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise ValueError("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET!")
+if WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    raise ValueError("WEBHOOK_SECRET: 1–256 символов A-Z, a-z, 0-9, _ и -")
+
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ==========================
-# Состояния
+# Параллельная обработка апдейтов
 # ==========================
-REPAIR_NAME, REPAIR_PHONE, REPAIR_TYPE, REPAIR_BRAND, REPAIR_MODEL, REPAIR_PROBLEM, REPAIR_CONFIRM = range(7)
-COURIER_NAME, COURIER_PHONE, COURIER_TYPE, COURIER_BRAND, COURIER_MODEL, COURIER_DIMENSIONS, COURIER_ADDRESS, COURIER_CONFIRM = range(10, 18)
-CARTRIDGE_NAME, CARTRIDGE_PHONE, CARTRIDGE_BRAND, CARTRIDGE_MODEL, CARTRIDGE_CARTRIDGE_MODEL, CARTRIDGE_ADDRESS, CARTRIDGE_CONFIRM = range(20, 27)
+def update_user_key(update: object):
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных пользователей идут параллельно (не больше limit сразу),
+    # апдейты одного пользователя — строго в порядке поступления, чтобы
+    # ConversationHandler не гонялся сам с собой.
+    # Пользователь сначала ждёт свою очередь и только потом занимает слот,
+    # поэтому поток сообщений от одного человека не забивает слоты остальным.
+    __slots__ = ("_slots", "_user_locks")
+
+    def __init__(self, limit: int, max_pending: int):
+        super().__init__(max_pending)
+        self._slots = asyncio.BoundedSemaphore(limit)
+        self._user_locks = {}  # key -> [Lock, сколько апдейтов ждут/работают]
+
+    async def do_process_update(self, update, coroutine):
+        key = update_user_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    @property
+    def pending(self) -> int:
+        # Апдейты, которые ждут своей очереди или обрабатываются
+        return sum(entry[1] for entry in self._user_locks.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class BoundedUpdateQueue(asyncio.Queue):
+    # При CONCURRENT_UPDATES > 1 Application забирает апдейт из очереди и сразу заводит
+    # под него задачу, не дожидаясь обработки: очередь сама по себе ничего не ограничивает.
+    # Здесь get() отдаёт апдейт, только если в работе меньше max_in_flight, а место
+    # освобождает task_done() — его Application зовёт по окончании обработки.
+    # Так в памяти не больше maxsize апдейтов в очереди и max_in_flight в задачах,
+    # а приём (getUpdates, webhook) ждёт на put()
+    def __init__(self, maxsize: int, max_in_flight: int):
+        super().__init__(maxsize)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def get(self):
+        await self._in_flight.acquire()
+        return await super().get()
+
+    def task_done(self):
+        super().task_done()
+        self._in_flight.release()
 
 # ==========================
 # Клавиатуры
 # ==========================
-def main_menu_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🛠️ Подать заявку на ремонт", callback_data="repair")],
-        [InlineKeyboardButton("🚚 Вызвать курьера", callback_data="courier")],
-        [InlineKeyboardButton("🖨️ Заправка картриджей", callback_data="cartridge")],
-        [InlineKeyboardButton("💻 Помощь системного администратора", callback_data="sysadmin")],
-        [InlineKeyboardButton("📍 Адрес и график работы", callback_data="contacts")],
-        [InlineKeyboardButton("💬 Связаться с оператором", callback_data="manager")],
-        [InlineKeyboardButton("📢 Наши каналы и магазин", callback_data="social")],
-    ])
-
-def cancel_keyboard():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
-
-def confirm_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Отправить заявку", callback_data="confirm")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-    ])
+# Собираются один раз: разметка неизменяемая, её можно отдавать в каждый ответ
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛠️ Подать заявку на ремонт", callback_data="repair")],
+    [InlineKeyboardButton("🚚 Вызвать курьера", callback_data="courier")],
+    [InlineKeyboardButton("🖨️ Заправка картриджей", callback_data="cartridge")],
+    [InlineKeyboardButton("💻 Помощь системного администратора", callback_data="sysadmin")],
+    [InlineKeyboardButton("📍 Адрес и график работы", callback_data="contacts")],
+    [InlineKeyboardButton("💬 Связаться с оператором", callback_data="manager")],
+    [InlineKeyboardButton("📢 Наши каналы и магазин", callback_data="social")],
+])
+
+CANCEL_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
+
+CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Отправить заявку", callback_data="confirm")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+
+ATTACH_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➡️ Без вложений", callback_data="attach")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+
+ATTACH_DONE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Готово", callback_data="attach")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+
+BACK_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ В меню", callback_data="main")]])
+
+END_CHAT_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Завершить переписку", callback_data="cancel")]])
+
+REPLY_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("💬 Ответить оператору", callback_data="manager")]])
 
 # ==========================
 # Главное меню
 # ==========================
-async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text="👋 Добро пожаловать! Чем поможем? 😊"):
+WELCOME_TEXT = "👋 Добро пожаловать! Чем поможем? 😊"
+
+def show_main_menu(replies: Replies, update: Update, text=WELCOME_TEXT):
     if update.callback_query:
-        await update.callback_query.message.edit_text(text, reply_markup=main_menu_keyboard())
+        replies.edit(update.callback_query.message, text, reply_markup=MAIN_MENU_KEYBOARD)
     else:
-        await update.message.reply_text(text, reply_markup=main_menu_keyboard())
+        replies.reply(update.message, text, reply_markup=MAIN_MENU_KEYBOARD)
+
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text=WELCOME_TEXT):
+    replies = Replies()
+    if update.callback_query:
+        replies.answer(update.callback_query)
+    show_main_menu(replies, update, text)
+    await replies.flush()
 
 # ==========================
 # Отмена
 # ==========================
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
-    await query.message.edit_text("🚫 Действие отменено.")
-    await main_menu(update, context, "Вернулись в главное меню 😊")
+    replies = Replies()
+    replies.answer(query)
+    # Меню встаёт на место того же сообщения — текст отмены идёт в нём, иначе его затрёт
+    show_main_menu(replies, update, "🚫 Действие отменено. Вернулись в главное меню 😊")
+    form_exit(context.bot_data, context.user_data.form, "cancelled")
     context.user_data.clear()
+    await replies.flush()
     return ConversationHandler.END
 
 # ==========================
@@ -78,408 +284,888 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # ==========================
 async def contacts_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    replies = Replies()
+    replies.answer(query)
     text = "🏢 Адрес: г. Днепр, ул. Княгини Ольги, 1 (2-й этаж)\n🕒 Пн–Пт 9:00–18:00, Сб 10:00–15:00\n📞 067 319 39 96\n💬 @trablnet\n✉️ office@kompomir.com"
-    kb = [[InlineKeyboardButton("⬅️ В меню", callback_data="main")]]
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(kb))
+    replies.edit(query.message, text, reply_markup=BACK_KEYBOARD)
+    await replies.flush()
 
 # ==========================
 # Наши каналы
 # ==========================
 async def social_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    replies = Replies()
+    replies.answer(query)
     text = "📢 Наши ресурсы:\n\n• Канал — @trablnet\n• Магазин — https://trablnet.com.ua 🛒"
-    kb = [[InlineKeyboardButton("⬅️ В меню", callback_data="main")]]
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(kb))
+    replies.edit(query.message, text, reply_markup=BACK_KEYBOARD)
+    await replies.flush()
 
 # ==========================
 # Оператор
 # ==========================
 async def manager_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    await query.message.reply_text("✍️ Напишите сообщение — оператор ответит максимально быстро 😊", reply_markup=cancel_keyboard())
-    context.user_data["chat_with_manager"] = True
+    replies = Replies()
+    replies.answer(query)
+    replies.reply(query.message, "✍️ Напишите сообщение — оператор ответит максимально быстро 😊", reply_markup=CANCEL_KEYBOARD)
+    await replies.flush()
+    context.user_data.chat_with_manager = True
 
 async def forward_manager(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get("chat_with_manager"):
-        user = update.message.from_user
-        text = f"💬 От {user.first_name} (@{user.username or 'нет'}):\n\n{update.message.text}"
-        await context.bot.send_message(OPERATOR_CHAT_ID, text)
-        await update.message.reply_text("✅ Отправлено! Скоро ответим 😊", reply_markup=main_menu_keyboard())
-        context.user_data["chat_with_manager"] = False
+    # Переписка идёт, пока клиент не завершит её кнопкой или не пропадёт на SESSION_IDLE
+    if context.user_data.chat_with_manager:
+        message = update.message
+        user = message.from_user
+        header = f"💬 От {user.first_name} (@{user.username or 'нет'}):"
+        # Через outbox: дойдёт и после 429 или перезапуска, а reply оператора вернётся клиенту
+        outbox, key = context.bot_data["outbox"], operator_key("relay", update)
+        if message.text:
+            outbox.put(key, OPERATOR_CHAT_ID, f"{header}\n\n{message.text}")
+        else:
+            # Фото, голосовое, файл — копией сообщения; где бывает подпись, в ней и отправитель
+            caption = f"{header}\n\n{message.caption}" if message.caption else header
+            captioned = any((message.photo, message.video, message.document, message.audio, message.voice,
+                             message.animation))
+            outbox.put(key, OPERATOR_CHAT_ID, caption[:CAPTION_LIMIT] if captioned else "",
+                       [[COPY, message.chat_id, message.message_id]])
+        await update.message.reply_text("✅ Отправлено! Оператор ответит здесь же, можно писать ещё 😊",
+                                        reply_markup=END_CHAT_KEYBOARD)
 
-# ==========================
-# Ремонт / Sysadmin — общие шаги
-# ==========================
-async def repair_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    context.user_data["mode"] = "repair"
-    await query.message.reply_text("🛠️ Запись на ремонт\n\n👤 Введите ваше имя:", reply_markup=cancel_keyboard())
-    return REPAIR_NAME
+def operator_key(kind: str, update: Update) -> str:
+    # Ключ сообщения операторам в outbox; последняя часть — чат клиента, куда пойдёт ответ
+    return f"{kind}:{update.update_id}:{update.effective_chat.id}"
 
-async def sysadmin_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    context.user_data["mode"] = "sysadmin"
-    await query.message.reply_text("💻 Помощь системного администратора\n\n👤 Введите ваше имя:", reply_markup=cancel_keyboard())
-    return REPAIR_NAME
-
-async def name_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    if not text:
-        await update.message.reply_text("❗ Имя не может быть пустым.")
-        return REPAIR_NAME
-    context.user_data["name"] = text
-    await update.message.reply_text("📱 Введите номер телефона:", reply_markup=cancel_keyboard())
-    return REPAIR_PHONE
-
-async def phone_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    # Оставляем только цифры для проверки длины
-    digits = ''.join(c for c in text if c.isdigit())
-    
-    if len(digits) < 9:
-        await update.message.reply_text(
-            "❗ Пожалуйста, введите номер телефона (минимум 9 цифр).\n"
-            "Можно писать любым удобным способом:\n"
-            "0671234567\n"
-            "+380671234567\n"
-            "050 123 45 67\n"
-            "(063) 987-65-43 и т.д."
-        )
-        return REPAIR_PHONE
-    
-    context.user_data["phone"] = text  # сохраняем как ввёл пользователь
-    await update.message.reply_text("🖥️ Тип оборудования (ноутбук, ПК, принтер и т.д.):", reply_markup=cancel_keyboard())
-    return REPAIR_TYPE
-
-async def type_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["type"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("🏷️ Бренд оборудования:", reply_markup=cancel_keyboard())
-    return REPAIR_BRAND
-
-async def brand_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["brand"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("🔧 Модель оборудования:", reply_markup=cancel_keyboard())
-    return REPAIR_MODEL
-
-async def model_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["model"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("⚠️ Опишите проблему:", reply_markup=cancel_keyboard())
-    return REPAIR_PROBLEM
-
-async def problem_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["problem"] = update.message.text.strip()
-    title = "🛠️ Заявка на ремонт" if context.user_data["mode"] == "repair" else "💻 Заявка на помощь системного администратора"
-    summary = (
-        f"{title}\n\n"
-        f"👤 Имя: {context.user_data.get('name', '—')}\n"
-        f"📱 Телефон: {context.user_data.get('phone', '—')}\n"
-        f"🖥️ Тип: {context.user_data.get('type', '—')}\n"
-        f"🏷️ Бренд: {context.user_data.get('brand', '—')}\n"
-        f"🔧 Модель: {context.user_data.get('model', '—')}\n"
-        f"⚠️ Проблема: {context.user_data.get('problem', '—')}"
-    )
-    await update.message.reply_text(summary + "\n\nВсё верно?", reply_markup=confirm_keyboard())
-    return REPAIR_CONFIRM
+def remember_relay(relay: RelayIndex, key: str, message):
+    # OutboxSender.on_sent: сообщение у операторов → чей это клиент
+    parts = key.split(":")
+    if len(parts) == 3:
+        relay.remember(message.message_id, int(parts[2]))
+
+async def relay_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Оператор ответил (reply) на сообщение клиента или на заявку — копируем ответ клиенту
+    message = update.message
+    chat_id = context.bot_data["relay"].lookup(message.reply_to_message.message_id)
+    if chat_id is None:
+        if (message.reply_to_message.text or "").startswith(DIGEST_TITLE):
+            # У сводки нет одного адресата — отвечают кнопкой под нужным уведомлением
+            await message.reply_text(DIGEST_REPLY_HINT)
+        return  # иначе операторы отвечают друг другу
+    try:
+        await message.copy(chat_id, reply_markup=REPLY_KEYBOARD)
+    except Forbidden:
+        await message.reply_text("❗ Не доставлено: клиент заблокировал бота.")
 
-async def repair_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+DIGEST_TITLE = "📦 Сводка:"
+DIGEST_REPLY_HINT = "❗ Не доставлено: это сводка. Нажмите «↩️ Ответить [N]» под нужным уведомлением."
+
+def operator_digest(tickets: TicketStore, items: list):
+    # OutboxSender.digest: несколько уведомлений одним сообщением, у каждого — своя строка кнопок
+    lines = [f"{DIGEST_TITLE} {len(items)}"]
+    keyboard = []
+    for number, (key, text) in enumerate(items, 1):
+        lines.append(f"\n[{number}] {text}")
+        kind, _, chat_id = key.split(":")
+        buttons = [InlineKeyboardButton(f"↩️ Ответить [{number}]", callback_data=f"reply:{chat_id}")]
+        ticket = tickets.by_key(key) if kind == "ticket" else None
+        if ticket is not None:
+            buttons.insert(0, InlineKeyboardButton(f"🔧 №{ticket['id']} в работу", callback_data=f"status:{ticket['id']}:work"))
+        keyboard.append(buttons)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def reply_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # По reply на сводку не понять, кому отвечать, — кнопка присылает запрос ответа для одного клиента
     query = update.callback_query
-    await query.answer()
-    if query.data != "confirm":
-        await query.message.edit_text("🚫 Заявка отменена.")
-        await main_menu(update, context)
-        context.user_data.clear()
-        return ConversationHandler.END
-    
-    title = "🛠️ Заявка на ремонт" if context.user_data["mode"] == "repair" else "💻 Заявка на помощь системного администратора"
-    msg = (
-        f"{title}\n"
-        f"👤 Имя: {context.user_data.get('name', '—')}\n"
-        f"📱 Телефон: {context.user_data.get('phone', '—')}\n"
-        f"🖥️ Тип: {context.user_data.get('type', '—')}\n"
-        f"🏷️ Бренд: {context.user_data.get('brand', '—')}\n"
-        f"🔧 Модель: {context.user_data.get('model', '—')}\n"
-        f"⚠️ Проблема: {context.user_data.get('problem', '—')}"
+    if query.message.chat_id != OPERATOR_CHAT_ID or len(context.args) != 1 or not context.args[0].isdigit():
+        await query.answer()
+        return
+    prompt, _ = await asyncio.gather(
+        query.message.reply_text("✍️ Ответьте на это сообщение — ответ уйдёт клиенту.",
+                                 reply_markup=ForceReply(input_field_placeholder="Ответ клиенту")),
+        query.answer(),
     )
-    await context.bot.send_message(OPERATOR_CHAT_ID, msg)
-    await query.message.edit_text("🎉 Заявка успешно отправлена!\nСкоро с вами свяжемся 😊")
-    await main_menu(update, context)
-    context.user_data.clear()
+    context.bot_data["relay"].remember(prompt.message_id, int(context.args[0]))
+
+# ==========================
+# Сессии
+# ==========================
+async def form_expired(update: Update) -> int:
+    # Шаг формы без самой формы — её убрал сборщик простоя; начинаем заново
+    replies = Replies()
+    if update.callback_query:
+        replies.answer(update.callback_query)
+    replies.reply(update.effective_message, "⌛ Заявка устарела, начните заново 😊", reply_markup=MAIN_MENU_KEYBOARD)
+    await replies.flush()
     return ConversationHandler.END
 
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.last_seen = time.time()
+
+def flood_kind(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    if update.callback_query:
+        return "callback"
+    data = context.user_data
+    if data.chat_with_manager and data.form is None:
+        return "forward"
+    return "message"
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Лишние апдейты от одного пользователя молча отбрасываем — до всех обработчиков
+    if update.effective_user is None or update.effective_chat is None:
+        return
+    if update.effective_chat.id == OPERATOR_CHAT_ID:
+        return
+    kind = flood_kind(update, context)
+    bucket = context.bot_data["flood"].get(kind)
+    if bucket is not None and not bucket.allow(update.effective_user.id):
+        context.bot_data["metrics"].inc("flood_dropped_total", kind)
+        raise ApplicationHandlerStop
+
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    form_exit(context.bot_data, context.user_data.form, "timeout")
+    context.user_data.form = None
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    app = context.application
+    before = time.time() - SESSION_IDLE
+    idle = [user_id for user_id, data in app.user_data.items() if data.last_seen < before]
+    for user_id in idle:
+        form_exit(app.bot_data, app.user_data[user_id].form, "idle")
+        app.drop_user_data(user_id)
+    stale, conversations = app.persistence.drop_stale(before) if app.persistence else (0, [])
+    drop_conversations(app, conversations)
+    app.bot_data["relay"].prune(time.time() - RELAY_TTL_DAYS * 86400)
+    for bucket in app.bot_data["flood"].values():
+        bucket.prune()
+    if idle or stale or conversations:
+        logger.info("Сессии: выгружено %d из памяти, удалено %d с диска, брошенных диалогов %d",
+                    len(idle), stale, len(conversations))
+
+def drop_conversations(app, conversations: list):
+    # Диалоги, поднятые с диска после перезапуска, живут без тайм-аута PTB: брошенные
+    # снимаем сами. Диалог с взведённым тайм-аутом ещё идёт — его не трогаем
+    handlers = {handler.name: handler for handlers in app.handlers.values() for handler in handlers
+                if isinstance(handler, ConversationHandler)}
+    for name, key in conversations:
+        handler = handlers.get(name)
+        if handler is not None and key not in handler.timeout_jobs:
+            handler._conversations.pop(key, None)
+
 # ==========================
-# Курьер
+# Формы заявок
 # ==========================
-async def courier_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+# Номер сразу приводится к E.164 (+380501234567): так он и хранится, и уходит операторам
+PHONE_ERROR = (
+    "❗ Пожалуйста, введите номер телефона.\n"
+    "Можно писать любым удобным способом:\n"
+    "0671234567\n"
+    "+380671234567\n"
+    "050 123 45 67\n"
+    "(063) 987-65-43 и т.д.\n"
+    "Номер не из Украины — с кодом страны через +."
+)
+ATTACH_PROMPT = (
+    "📎 Если хотите, пришлите фото поломки, экрана с ошибкой или документ "
+    f"(до {ALBUM_LIMIT} файлов, можно альбомом). Или нажмите «Без вложений»."
+)
+ATTACH_HINT = "📎 Здесь ждём фото или файл. Больше ничего — нажмите «Без вложений»."
+NAME_ERROR = "❗ Имя не может быть пустым."
+ADDRESS_ERROR = "❗ Адрес обязателен."
+
+# Новая услуга — ещё один Flow; номера состояний у услуг не должны пересекаться
+FLOWS = (
+    Flow(
+        kind="repair",
+        first_state=0,
+        modes={
+            "repair": ("🛠️ Запись на ремонт", "🛠️ Заявка на ремонт"),
+            "sysadmin": ("💻 Помощь системного администратора", "💻 Заявка на помощь системного администратора"),
+        },
+        fields=[
+            Field("name", "👤 Имя", "👤 Введите ваше имя:", required=True, error=NAME_ERROR),
+            Field("phone", "📱 Телефон", "📱 Введите номер телефона:", required=True, validator=normalize_phone, error=PHONE_ERROR),
+            Field("type", "🖥️ Тип", "🖥️ Тип оборудования (ноутбук, ПК, принтер и т.д.):", suggest="type"),
+            Field("brand", "🏷️ Бренд", "🏷️ Бренд оборудования:", suggest="brand"),
+            Field("model", "🔧 Модель", "🔧 Модель оборудования:", suggest="model"),
+            Field("problem", "⚠️ Проблема", "⚠️ Опишите проблему:"),
+        ],
+        done="🎉 Заявка успешно отправлена!\nСкоро с вами свяжемся 😊",
+        cancelled="🚫 Заявка отменена.",
+        attach_prompt=ATTACH_PROMPT,
+    ),
+    Flow(
+        kind="courier",
+        first_state=10,
+        modes={"courier": ("🚚 Вызов курьера", "🚚 Заявка на вызов курьера")},
+        fields=[
+            Field("name", "👤 Имя", "👤 Введите ваше имя:", required=True, error=NAME_ERROR),
+            Field("phone", "📱 Телефон", "📱 Номер телефона:", required=True, validator=normalize_phone, error=PHONE_ERROR),
+            Field("type", "🖥️ Тип", "🖥️ Тип оборудования:", suggest="type"),
+            Field("brand", "🏷️ Бренд", "🏷️ Бренд:", suggest="brand"),
+            Field("model", "🔧 Модель", "🔧 Модель:", suggest="model"),
+            Field("dimensions", "📏 Габариты", "📏 Габариты (если знаете, Д×Ш×В см):"),
+            Field("address", "📍 Адрес", "📍 Полный адрес забора:", required=True, error=ADDRESS_ERROR),
+        ],
+        done="🚚 Заявка отправлена! 🎉 Скоро свяжемся 😊",
+        cancelled="🚫 Отменено.",
+        attach_prompt=ATTACH_PROMPT,
+    ),
+    Flow(
+        kind="cartridge",
+        first_state=20,
+        modes={"cartridge": ("🖨️ Заправка картриджей", "🖨️ Заявка на заправку картриджей")},
+        fields=[
+            Field("name", "👤 Имя", "👤 Введите ваше имя:", required=True, error=NAME_ERROR),
+            Field("phone", "📱 Телефон", "📱 Номер телефона:", required=True, validator=normalize_phone, error=PHONE_ERROR),
+            Field("brand", "🏷️ Бренд принтера", "🏷️ Бренд принтера / МФУ:", suggest="brand"),
+            Field("model", "🖨️ Модель принтера", "🖨️ Модель принтера / МФУ:", suggest="model"),
+            Field("cartridge", "🔋 Модель картриджа", "🔋 Модель картриджа (если знаете):", suggest="cartridge"),
+            Field("address", "📍 Адрес", "📍 Полный адрес (улица, дом, квартира / частный дом):", required=True, error=ADDRESS_ERROR),
+        ],
+        done="🖨️ Заявка отправлена! 🎉 Скоро свяжемся 😊",
+        cancelled="🚫 Отменено.",
+        attach_prompt=ATTACH_PROMPT,
+    ),
+)
+FLOWS_BY_KIND = {flow.kind: flow for flow in FLOWS}
+
+def form_exit(bot_data: dict, form, reason: str):
+    # Воронка: на каком шаге пользователь ушёл из формы, не отправив её — в метрики и статистику
+    flow = FLOWS_BY_KIND.get(form.kind) if form is not None else None
+    if flow is None:
+        return
+    step = flow.position(form)
+    bot_data["metrics"].inc("form_exits_total", flow.kind, step, reason)
+    brand = getattr(form, "brand", EMPTY)
+    bot_data["tickets"].count(form.mode, "" if brand == EMPTY else brand, reason, step)
+
+async def form_start(flow: Flow, mode: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
-    await query.message.reply_text("🚚 Вызов курьера\n\n👤 Введите ваше имя:", reply_markup=cancel_keyboard())
-    return COURIER_NAME
-
-async def courier_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    if not text:
-        await update.message.reply_text("❗ Имя не может быть пустым.")
-        return COURIER_NAME
-    context.user_data["c_name"] = text
-    await update.message.reply_text("📱 Номер телефона:", reply_markup=cancel_keyboard())
-    return COURIER_PHONE
-
-async def courier_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    digits = ''.join(c for c in text if c.isdigit())
-    
-    if len(digits) < 9:
-        await update.message.reply_text(
-            "❗ Пожалуйста, введите номер телефона (минимум 9 цифр).\n"
-            "Можно писать любым удобным способом:\n"
-            "0671234567  +380671234567  050 123 45 67  (063)987-65-43"
-        )
-        return COURIER_PHONE
-    
-    context.user_data["c_phone"] = text
-    await update.message.reply_text("🖥️ Тип оборудования:", reply_markup=cancel_keyboard())
-    return COURIER_TYPE
-
-async def courier_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["c_type"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("🏷️ Бренд:", reply_markup=cancel_keyboard())
-    return COURIER_BRAND
-
-async def courier_brand(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["c_brand"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("🔧 Модель:", reply_markup=cancel_keyboard())
-    return COURIER_MODEL
-
-async def courier_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["c_model"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("📏 Габариты (если знаете, Д×Ш×В см):", reply_markup=cancel_keyboard())
-    return COURIER_DIMENSIONS
-
-async def courier_dimensions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["c_dimensions"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("📍 Полный адрес забора:", reply_markup=cancel_keyboard())
-    return COURIER_ADDRESS
-
-async def courier_address(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    if not text:
-        await update.message.reply_text("❗ Адрес обязателен.")
-        return COURIER_ADDRESS
-    context.user_data["c_address"] = text
-    
-    summary = (
-        "🚚 Заявка на вызов курьера\n\n"
-        f"👤 Имя: {context.user_data.get('c_name', '—')}\n"
-        f"📱 Телефон: {context.user_data.get('c_phone', '—')}\n"
-        f"🖥️ Тип: {context.user_data.get('c_type', '—')}\n"
-        f"🏷️ Бренд: {context.user_data.get('c_brand', '—')}\n"
-        f"🔧 Модель: {context.user_data.get('c_model', '—')}\n"
-        f"📏 Габариты: {context.user_data.get('c_dimensions', '—')}\n"
-        f"📍 Адрес: {context.user_data.get('c_address', '—')}"
+    context.user_data.form = flow.new_form(mode)
+    context.bot_data["metrics"].inc("form_steps_total", flow.kind, flow.fields[0].key)
+    replies = Replies()
+    replies.answer(query)
+    replies.reply(query.message, flow.intros[mode], reply_markup=CANCEL_KEYBOARD)
+    await replies.flush()
+    return flow.first_state
+
+async def form_step(step: Step, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    flow = step.flow
+    form = context.user_data.form
+    if not isinstance(form, flow.form_cls):
+        return await form_expired(update)
+    value = step.field.clean(update.message.text)
+    if value is None:
+        await update.message.reply_text(step.field.error)
+        return step.state
+    field = step.field
+    if field.suggest and SUGGEST_LIMIT and value != field.default:
+        # Известное значение — в привычном написании; начало известного — предлагаем кнопки
+        suggestions = context.bot_data["suggestions"]
+        metrics = context.bot_data["metrics"]
+        known = suggestions.exact(field.suggest, value)
+        if known:
+            value = known
+            metrics.inc("form_suggest_total", field.suggest, "exact")
+        else:
+            options = suggestions.search(field.suggest, value, suggest_scope(field, form), SUGGEST_LIMIT)
+            if options:
+                setattr(form, field.key, value)
+                await update.message.reply_text(f"🔎 Может, одно из этих? Или оставьте «{value}».",
+                                                reply_markup=pick_markup(field, options, keep=value))
+                return step.state
+            metrics.inc("form_suggest_total", field.suggest, "none")
+    setattr(form, field.key, value)
+    text, markup = next_prompt(step, form, context)
+    await update.message.reply_text(text, reply_markup=markup)
+    return step.next_state
+
+async def form_pick(step: Step, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # Кнопка подсказки под вопросом или после неполного ввода; «keep» — оставить как написано
+    form = context.user_data.form
+    if not isinstance(form, step.flow.form_cls):
+        return await form_expired(update)
+    query = update.callback_query
+    field = step.field
+    key, *rest = context.args
+    if key != field.key:
+        # Кнопка под одним из прошлых вопросов — в текущее поле её не пишем
+        await query.answer()
+        return step.state
+    if query.data.startswith("keep:"):
+        value, result = getattr(form, field.key), "kept"
+    else:
+        value, result = ":".join(rest), "picked"
+    if value == EMPTY:
+        await query.answer()
+        return step.state
+    setattr(form, field.key, value)
+    context.bot_data["metrics"].inc("form_suggest_total", field.suggest, result)
+    text, markup = next_prompt(step, form, context)
+    replies = Replies()
+    replies.answer(query)
+    replies.edit(query.message, f"{field.label}: {value}")
+    replies.reply(query.message, text, reply_markup=markup)
+    await replies.flush()
+    return step.next_state
+
+def next_prompt(step: Step, form, context: ContextTypes.DEFAULT_TYPE):
+    # Поле step заполнено: следующий вопрос (или итог) и кнопки к нему
+    flow = step.flow
+    context.bot_data["metrics"].inc("form_steps_total", flow.kind, step.next_key)
+    if step.next_prompt is None:
+        form.summary = flow.render(form)
+        return flow.summary(form), CONFIRM_KEYBOARD
+    if step.next_key == ATTACH_STEP:
+        return step.next_prompt, ATTACH_KEYBOARD
+    field = step.next_field
+    if not (field.suggest and SUGGEST_LIMIT):
+        return step.next_prompt, CANCEL_KEYBOARD
+    # Под вопросом — самые частые ответы; модели — только выбранного бренда
+    popular = context.bot_data["suggestions"].search(field.suggest, "", suggest_scope(field, form),
+                                                     SUGGEST_LIMIT, fallback=False)
+    return step.next_prompt, pick_markup(field, popular)
+
+# Модели и картриджи подсказываются в пределах бренда из той же заявки
+SCOPED_SUGGEST = ("model", "cartridge")
+
+def suggest_scope(field: Field, form) -> str:
+    brand = getattr(form, "brand", NOT_SPECIFIED)
+    if field.suggest not in SCOPED_SUGGEST or brand in (EMPTY, NOT_SPECIFIED):
+        return ""
+    return brand
+
+def pick_markup(field: Field, options: list, keep: str = None) -> InlineKeyboardMarkup:
+    # По две подсказки в ряд; не влезающие в 64 байта callback_data не показываем.
+    # В данных — ключ поля: кнопки прошлых вопросов не попадут в текущее поле
+    data = [(option, f"pick:{field.key}:{option}") for option in options]
+    buttons = [InlineKeyboardButton(option, callback_data=value) for option, value in data if len(value.encode()) <= 64]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if keep is not None:
+        rows.append([InlineKeyboardButton(f"✏️ Оставить «{keep}»", callback_data=f"keep:{field.key}")])
+    return InlineKeyboardMarkup(rows + [[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
+
+def learn_ticket(suggestions: Suggestions, flow: Flow, form):
+    # Каждая отправленная заявка сразу поднимает свои значения в подсказках
+    for field in flow.fields:
+        value = getattr(form, field.key)
+        if field.suggest and value not in (EMPTY, field.default):
+            suggestions.learn(field.suggest, value, suggest_scope(field, form))
+
+def learn_history(suggestions: Suggestions, tickets: TicketStore) -> int:
+    # При запуске: значения прошлых заявок с весом «сколько раз встречалось»
+    learned = 0
+    for flow in FLOWS:
+        keys = [field.key for field in flow.fields]
+        for field in flow.fields:
+            if not field.suggest:
+                continue
+            scoped = field.suggest in SCOPED_SUGGEST and "brand" in keys
+            for *values, count in tickets.field_counts(flow.kind, ("brand", field.key) if scoped else (field.key,)):
+                value, scope = values[-1], values[0] if scoped else ""
+                if value is None or value == field.default:
+                    continue
+                suggestions.learn(field.suggest, value, "" if scope == NOT_SPECIFIED else scope, count)
+                learned += 1
+    return learned
+
+async def form_attach(flow: Flow, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # Запоминаем только file_id: сам файл остаётся у Telegram, операторам уйдёт по нему же
+    form = context.user_data.form
+    if not isinstance(form, flow.form_cls):
+        return await form_expired(update)
+    message = update.message
+    attachments = flow.attachments(form)
+    if len(attachments) < ALBUM_LIMIT:
+        if message.photo:
+            attachments.append(["photo", message.photo[-1].file_id])
+        else:
+            attachments.append(["document", message.document.file_id])
+    form.attachments = attachments
+    # Файлы альбома идут подряд отдельными апдейтами — один ответ, когда они закончатся
+    name = f"attach:{update.effective_user.id}"
+    for job in context.job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    context.job_queue.run_once(attach_received, ATTACH_DEBOUNCE, name=name,
+                               chat_id=message.chat_id, user_id=update.effective_user.id)
+    return flow.attach_state
+
+async def attach_received(context: ContextTypes.DEFAULT_TYPE):
+    form = context.user_data.form
+    flow = FLOWS_BY_KIND.get(form.kind) if form is not None else None
+    if flow is None or flow.position(form) != ATTACH_STEP:
+        return  # клиент уже нажал «Готово» или вышел из формы
+    count = len(flow.attachments(form))
+    more = "Пришлите ещё или нажмите «Готово»." if count < ALBUM_LIMIT else "Больше не поместится — нажмите «Готово»."
+    await context.bot.send_message(context.job.chat_id, f"📎 Получено файлов: {count}. {more}",
+                                   reply_markup=ATTACH_DONE_KEYBOARD)
+
+async def form_attach_hint(flow: Flow, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text(ATTACH_HINT, reply_markup=ATTACH_KEYBOARD)
+    return flow.attach_state
+
+async def form_attach_done(flow: Flow, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    form = context.user_data.form
+    if not isinstance(form, flow.form_cls):
+        return await form_expired(update)
+    for job in context.job_queue.get_jobs_by_name(f"attach:{update.effective_user.id}"):
+        job.schedule_removal()
+    form.summary = flow.render(form)
+    context.bot_data["metrics"].inc("form_steps_total", flow.kind, CONFIRM_STEP)
+    query = update.callback_query
+    replies = Replies()
+    replies.answer(query)
+    replies.edit(query.message, flow.summary(form), reply_markup=CONFIRM_KEYBOARD)
+    await replies.flush()
+    return flow.confirm_state
+
+def submit_ticket(flow: Flow, form, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metrics = context.bot_data["metrics"]
+    values = {field.key: getattr(form, field.key) for field in flow.fields}
+    attachments = flow.attachments(form)
+    recent = context.bot_data["recent_tickets"]
+    content = hash((*values.values(), *(file_id for _, file_id in attachments)))
+    seen = recent.check(form.phone, flow.kind, content) if recent is not None else None
+    if seen and seen[1]:
+        # Та же заявка ещё раз — у операторов она уже есть
+        metrics.inc("form_duplicates_total", flow.kind, "merged")
+        context.bot_data["tickets"].count(form.mode, getattr(form, "brand", ""), "merged")
+        return
+
+    key = operator_key("ticket", update)
+    ticket_id = context.bot_data["tickets"].add(
+        key, flow.kind, form.mode, update.effective_user.id, form.phone, getattr(form, "brand", ""),
+        {**values, "attachments": attachments} if attachments else values,
     )
-    await update.message.reply_text(summary + "\n\nВсё верно?", reply_markup=confirm_keyboard())
-    return COURIER_CONFIRM
+    text = flow.ticket(form, ticket_id)
+    if seen:
+        text = f"🔁 С этого номера недавно была заявка №{seen[0]}\n{text}"
+        metrics.inc("form_duplicates_total", flow.kind, "flagged")
+    outbox = context.bot_data["outbox"]
+    outbox.put(key, OPERATOR_CHAT_ID, text)
+    for number, media in enumerate(media_groups(attachments)):
+        outbox.put(operator_key(f"media{number}", update), OPERATOR_CHAT_ID, f"📎 К заявке №{ticket_id}", media)
+    if recent is not None:
+        recent.remember(form.phone, flow.kind, content, ticket_id)
+    learn_ticket(context.bot_data["suggestions"], flow, form)
+    metrics.inc("form_steps_total", flow.kind, "done")
 
-async def courier_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def form_confirm(flow: Flow, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    form = context.user_data.form
+    if not isinstance(form, flow.form_cls):
+        return await form_expired(update)
     query = update.callback_query
-    await query.answer()
+    replies = Replies()
+    replies.answer(query)
+    # Итог — текстом меню: меню правит то же сообщение, и отдельная правка до него не видна
     if query.data != "confirm":
-        await query.message.edit_text("🚫 Отменено.")
-        await main_menu(update, context)
-        context.user_data.clear()
-        return ConversationHandler.END
-    
-    msg = (
-        "🚚 Заявка на вызов курьера\n"
-        f"👤 Имя: {context.user_data.get('c_name', '—')}\n"
-        f"📱 Телефон: {context.user_data.get('c_phone', '—')}\n"
-        f"🖥️ Тип: {context.user_data.get('c_type', '—')}\n"
-        f"🏷️ Бренд: {context.user_data.get('c_brand', '—')}\n"
-        f"🔧 Модель: {context.user_data.get('c_model', '—')}\n"
-        f"📏 Габариты: {context.user_data.get('c_dimensions', '—')}\n"
-        f"📍 Адрес: {context.user_data.get('c_address', '—')}"
-    )
-    await context.bot.send_message(OPERATOR_CHAT_ID, msg)
-    await query.message.edit_text("🚚 Заявка отправлена! 🎉 Скоро свяжемся 😊")
-    await main_menu(update, context)
+        form_exit(context.bot_data, form, "cancelled")
+        show_main_menu(replies, update, flow.cancelled)
+    else:
+        submit_ticket(flow, form, update, context)
+        show_main_menu(replies, update, flow.done)
     context.user_data.clear()
+    await replies.flush()
     return ConversationHandler.END
 
+FORM_TEXT = filters.TEXT & ~filters.COMMAND
+ATTACH_FILES = filters.PHOTO | filters.Document.ALL
+# Что клиент может прислать оператору кроме текста (уходит копией)
+RELAY_MEDIA = (ATTACH_FILES | filters.VIDEO | filters.AUDIO | filters.VOICE | filters.VIDEO_NOTE | filters.ANIMATION
+               | filters.Sticker.ALL | filters.LOCATION | filters.CONTACT)
+
 # ==========================
-# Заправка картриджей
+# Заявки для операторов: поиск, открытые, статусы
 # ==========================
-async def cartridge_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    await query.message.reply_text("🖨️ Заправка картриджей\n\n👤 Введите ваше имя:", reply_markup=cancel_keyboard())
-    return CARTRIDGE_NAME
-
-async def cartridge_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    if not text:
-        await update.message.reply_text("❗ Имя не может быть пустым.")
-        return CARTRIDGE_NAME
-    context.user_data["cr_name"] = text
-    await update.message.reply_text("📱 Номер телефона:", reply_markup=cancel_keyboard())
-    return CARTRIDGE_PHONE
-
-async def cartridge_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    digits = ''.join(c for c in text if c.isdigit())
-    
-    if len(digits) < 9:
-        await update.message.reply_text(
-            "❗ Пожалуйста, введите номер телефона (минимум 9 цифр).\n"
-            "Можно писать любым удобным способом:\n"
-            "0671234567  +380671234567  050 123 45 67  (063)987-65-43"
-        )
-        return CARTRIDGE_PHONE
-    
-    context.user_data["cr_phone"] = text
-    await update.message.reply_text("🏷️ Бренд принтера / МФУ:", reply_markup=cancel_keyboard())
-    return CARTRIDGE_BRAND
-
-async def cartridge_brand(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["cr_brand"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("🖨️ Модель принтера / МФУ:", reply_markup=cancel_keyboard())
-    return CARTRIDGE_MODEL
-
-async def cartridge_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["cr_model"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("🔋 Модель картриджа (если знаете):", reply_markup=cancel_keyboard())
-    return CARTRIDGE_CARTRIDGE_MODEL
-
-async def cartridge_cartridge_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["cr_cartridge"] = update.message.text.strip() or "не указано"
-    await update.message.reply_text("📍 Полный адрес (улица, дом, квартира / частный дом):", reply_markup=cancel_keyboard())
-    return CARTRIDGE_ADDRESS
-
-async def cartridge_address(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text.strip()
-    if not text:
-        await update.message.reply_text("❗ Адрес обязателен.")
-        return CARTRIDGE_ADDRESS
-    context.user_data["cr_address"] = text
-    
-    summary = (
-        "🖨️ Заявка на заправку картриджей\n\n"
-        f"👤 Имя: {context.user_data.get('cr_name', '—')}\n"
-        f"📱 Телефон: {context.user_data.get('cr_phone', '—')}\n"
-        f"🏷️ Бренд принтера: {context.user_data.get('cr_brand', '—')}\n"
-        f"🖨️ Модель принтера: {context.user_data.get('cr_model', '—')}\n"
-        f"🔋 Модель картриджа: {context.user_data.get('cr_cartridge', '—')}\n"
-        f"📍 Адрес: {context.user_data.get('cr_address', '—')}"
+TICKET_STATUSES = {"new": "🆕 новая", "work": "🔧 в работе", "done": "✅ выполнена", "cancelled": "🚫 отменена"}
+TICKETS_HELP = (
+    "/find <телефон или бренд> [дней] — заявки по номеру или бренду\n"
+    "/open [услуга] — открытые заявки (услуги: " + ", ".join(FLOWS_BY_KIND) + ")\n"
+    "/status <№> <" + "|".join(STATUSES) + "> — сменить статус\n"
+    "/stats [дней] — сколько заявок и брошенных форм (по умолчанию за 7 дней)"
+)
+STATS_DAYS = 7
+EXIT_REASONS = {"cancelled": "отмена", "timeout": "тайм-аут", "idle": "простой", "merged": "повтор"}
+
+def ticket_line(row) -> str:
+    flow = FLOWS_BY_KIND.get(row["flow"])
+    title = flow.titles.get(row["mode"], row["flow"]) if flow else row["flow"]
+    data = json.loads(row["data"])
+    created = time.strftime("%d.%m.%Y %H:%M", time.localtime(row["created_at"]))
+    return (
+        f"№{row['id']} · {created} · {TICKET_STATUSES[row['status']]}\n{title}\n"
+        f"👤 {data.get('name', '')} · 📱 {row['phone']} · 🏷️ {data.get('brand', '—')}"
     )
-    await update.message.reply_text(summary + "\n\nВсё верно?", reply_markup=confirm_keyboard())
-    return CARTRIDGE_CONFIRM
 
-async def cartridge_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+def tickets_page(store: TicketStore, kind: str, query: str, days: int, before=None):
+    # Страница списка и кнопка «Дальше»; в callback_data — всё, чтобы продолжить с того же места
+    since = time.time() - days * 86400 if days else None
+    limit = TICKETS_PAGE + 1  # лишняя строка — признак следующей страницы
+    if kind == "phone":
+        rows = store.find_phone(query, before=before, limit=limit, since=since)
+        title = f"🔎 Заявки по номеру {query}"
+    elif kind == "brand":
+        rows = store.find_brand(query, before=before, limit=limit, since=since)
+        title = f"🔎 Заявки по бренду {query}"
+    else:
+        rows = store.open_tickets(query or None, before=before, limit=limit)
+        title = "📋 Открытые заявки" + (f" ({query})" if query else "")
+    if days:
+        title += f" за {days} дн."
+    if not rows:
+        return f"{title}: ничего не найдено.", None
+    page, more = rows[:TICKETS_PAGE], len(rows) > TICKETS_PAGE
+    text = title + "\n\n" + "\n\n".join(ticket_line(row) for row in page)
+    markup = None
+    data = f"tickets:{kind}:{page[-1]['id']}:{days}:{query}"
+    if more and len(data.encode()) <= 64:
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("Дальше ▶️", callback_data=data)]])
+    return text, markup
+
+async def find_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    # Номер с пробелами («050 123 45 67») целиком — телефон; иначе последнее число — за сколько дней
+    phone = normalize_phone(" ".join(args))
+    days = int(args.pop()) if not phone and len(args) > 1 and args[-1].isdigit() and len(args[-1]) <= 4 else 0
+    query = " ".join(args)
+    if not query:
+        await update.message.reply_text(TICKETS_HELP)
+        return
+    kind = "phone" if phone or normalize_phone(query) else "brand"
+    text, markup = tickets_page(context.bot_data["tickets"], kind, query, days)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def open_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    flow = context.args[0] if context.args else ""
+    if flow and flow not in FLOWS_BY_KIND:
+        await update.message.reply_text(TICKETS_HELP)
+        return
+    text, markup = tickets_page(context.bot_data["tickets"], "open", flow, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def tickets_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    if query.data != "confirm":
-        await query.message.edit_text("🚫 Отменено.")
-        await main_menu(update, context)
-        context.user_data.clear()
-        return ConversationHandler.END
-    
-    msg = (
-        "🖨️ Заявка на заправку картриджей\n"
-        f"👤 Имя: {context.user_data.get('cr_name', '—')}\n"
-        f"📱 Телефон: {context.user_data.get('cr_phone', '—')}\n"
-        f"🏷️ Бренд принтера: {context.user_data.get('cr_brand', '—')}\n"
-        f"🖨️ Модель принтера: {context.user_data.get('cr_model', '—')}\n"
-        f"🔋 Модель картриджа: {context.user_data.get('cr_cartridge', '—')}\n"
-        f"📍 Адрес: {context.user_data.get('cr_address', '—')}"
+    replies = Replies()
+    replies.answer(query)
+    if query.message.chat_id == OPERATOR_CHAT_ID and len(context.args) >= 4:
+        kind, before, days = context.args[0], int(context.args[1]), int(context.args[2])
+        text, markup = tickets_page(context.bot_data["tickets"], kind, ":".join(context.args[3:]), days, before)
+        replies.edit(query.message, text, reply_markup=markup)
+    await replies.flush()
+
+async def set_ticket_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    if len(args) != 2 or not args[0].lstrip("№#").isdigit() or args[1] not in STATUSES:
+        await update.message.reply_text(TICKETS_HELP)
+        return
+    ticket_id = int(args[0].lstrip("№#"))
+    if context.bot_data["tickets"].set_status(ticket_id, args[1]):
+        await update.message.reply_text(f"№{ticket_id}: {TICKET_STATUSES[args[1]]}")
+    else:
+        await update.message.reply_text(f"❗ Заявки №{ticket_id} нет.")
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Отчёт из счётчиков по дням (stats.py): история заявок не перечитывается
+    args = context.args
+    if len(args) > 1 or (args and not (args[0].isdigit() and 0 < int(args[0]) <= 3660)):
+        await update.message.reply_text(TICKETS_HELP)
+        return
+    days = int(args[0]) if args else STATS_DAYS
+    since = time.time() - (days - 1) * 86400
+    await update.message.reply_text(stats_text(context.bot_data["tickets"].stats, days, since))
+
+def stats_text(stats, days: int, since: float) -> str:
+    summary = stats.summary(day_of(since))
+    titles = {mode: title for flow in FLOWS for mode, title in flow.titles.items()}
+    done, exits = summary["done"], summary["exits"]
+    lines = [f"📊 За {days} дн. (с {time.strftime('%d.%m.%Y', time.localtime(since))})",
+             f"✅ Заявок: {sum(done.values())}"]
+    lines += [f"  {titles.get(mode, mode)}: {count}" for mode, count in done.most_common()]
+    if exits:
+        reasons = ", ".join(f"{EXIT_REASONS.get(reason, reason)} {count}" for reason, count in exits.most_common())
+        lines.append(f"🚪 Без заявки: {sum(exits.values())} ({reasons})")
+        lines += [f"  {titles.get(mode, mode)} · {step}: {count}"
+                  for (mode, step), count in summary["steps"].most_common(5)]
+    if summary["brands"]:
+        lines.append("🏷️ Бренды: " + ", ".join(f"{brand or '—'} {count}"
+                                              for brand, count in summary["brands"].most_common(10)))
+    if len(summary["days"]) > 1:
+        lines.append("📅 По дням: " + ", ".join(f"{day[8:10]}.{day[5:7]} {count}"
+                                               for day, count in sorted(summary["days"].items())[-14:]))
+    return "\n".join(lines)
+
+async def status_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    args = context.args
+    if query.message.chat_id != OPERATOR_CHAT_ID or len(args) != 2 or not args[0].isdigit() or args[1] not in STATUSES:
+        await query.answer()
+        return
+    ticket_id = int(args[0])
+    if context.bot_data["tickets"].set_status(ticket_id, args[1]):
+        await query.answer(f"№{ticket_id}: {TICKET_STATUSES[args[1]]}")
+    else:
+        await query.answer(f"❗ Заявки №{ticket_id} нет.")
+
+def form_conversation(flow: Flow) -> ConversationHandler:
+    states = {
+        step.state: [MessageHandler(FORM_TEXT, functools.partial(form_step, step))]
+        for step in flow.steps
+    }
+    for step in flow.steps:
+        if step.field.suggest:
+            pick = functools.partial(form_pick, step)
+            states[step.state].append(CallbackRouter({"pick": pick, "keep": pick}))
+    confirm = functools.partial(form_confirm, flow)
+    states[flow.confirm_state] = [CallbackRouter({"confirm": confirm, "cancel": confirm})]
+    if flow.attach_state is not None:
+        states[flow.attach_state] = [
+            MessageHandler(ATTACH_FILES, functools.partial(form_attach, flow)),
+            MessageHandler(FORM_TEXT, functools.partial(form_attach_hint, flow)),
+            CallbackRouter({"attach": functools.partial(form_attach_done, flow)}),
+        ]
+    states[ConversationHandler.TIMEOUT] = [TypeHandler(Update, conversation_timeout)]
+    return ConversationHandler(
+        entry_points=[CallbackRouter({mode: functools.partial(form_start, flow, mode) for mode in flow.modes})],
+        states=states,
+        fallbacks=[CallbackRouter({"cancel": cancel})],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        # Кнопка услуги всегда начинает форму заново — даже если застрял старый диалог
+        allow_reentry=True,
+        name=f"{flow.kind}_conv",
+        persistent=True,
     )
-    await context.bot.send_message(OPERATOR_CHAT_ID, msg)
-    await query.message.edit_text("🖨️ Заявка отправлена! 🎉 Скоро свяжемся 😊")
-    await main_menu(update, context)
-    context.user_data.clear()
-    return ConversationHandler.END
 
 # ==========================
 # ЗАПУСК
 # ==========================
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    
-    # Общие
-    app.add_handler(CallbackQueryHandler(cancel, pattern="^cancel$"))
-    app.add_handler(CallbackQueryHandler(lambda u, c: main_menu(u, c), pattern="^main$"))
-    
-    # Статические
-    app.add_handler(CallbackQueryHandler(contacts_handler, pattern="^contacts$"))
-    app.add_handler(CallbackQueryHandler(social_handler, pattern="^social$"))
-    app.add_handler(CallbackQueryHandler(manager_handler, pattern="^manager$"))
-    
-    # Ремонт + Sysadmin
-    repair_conv = ConversationHandler(
-        entry_points=[
-            CallbackQueryHandler(repair_start, pattern="^repair$"),
-            CallbackQueryHandler(sysadmin_start, pattern="^sysadmin$"),
-        ],
-        states={
-            REPAIR_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, name_step)],
-            REPAIR_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, phone_step)],
-            REPAIR_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, type_step)],
-            REPAIR_BRAND: [MessageHandler(filters.TEXT & ~filters.COMMAND, brand_step)],
-            REPAIR_MODEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, model_step)],
-            REPAIR_PROBLEM: [MessageHandler(filters.TEXT & ~filters.COMMAND, problem_step)],
-            REPAIR_CONFIRM: [CallbackQueryHandler(repair_confirm, pattern="^(confirm|cancel)$")],
-        },
-        fallbacks=[CallbackQueryHandler(cancel, pattern="^cancel$")],
-        conversation_timeout=900,
+# Какие типы апдейтов реально разбирают обработчики
+HANDLER_UPDATE_TYPES = (
+    (CallbackRouter, Update.CALLBACK_QUERY),
+    (CallbackQueryHandler, Update.CALLBACK_QUERY),
+    (CommandHandler, Update.MESSAGE),
+    (MessageHandler, Update.MESSAGE),
+)
+
+def handler_update_types(handlers) -> set:
+    types = set()
+    for handler in handlers:
+        if isinstance(handler, TypeHandler):
+            # Служебные обработчики (простой, тайм-аут) сами апдейтов не заказывают
+            continue
+        if isinstance(handler, ConversationHandler):
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            types |= handler_update_types(nested)
+            continue
+        for handler_cls, update_type in HANDLER_UPDATE_TYPES:
+            if isinstance(handler, handler_cls):
+                types.add(update_type)
+                break
+        else:
+            # Незнакомый обработчик — не рискуем потерять апдейты
+            return set(Update.ALL_TYPES)
+    return types
+
+def allowed_updates(app) -> list:
+    types = set()
+    for handlers in app.handlers.values():
+        types |= handler_update_types(handlers)
+    return sorted(types)
+
+def handler_name(callback) -> str:
+    # Имя обработчика в метриках; у форм — услуга и шаг: repair.phone, courier.confirm
+    if isinstance(callback, functools.partial):
+        target = callback.args[0]
+        if isinstance(target, Step):
+            name = f"{target.flow.kind}.{target.field.key}"
+            return name if callback.func is form_step else f"{name}.{callback.func.__name__.removeprefix('form_')}"
+        return f"{target.kind}.{callback.func.__name__.removeprefix('form_')}"
+    return callback.__name__
+
+def register_gauges(app, metrics):
+    metrics.gauge("bot_update_queue_size", "Апдейты в очереди на обработку", app.update_queue.qsize)
+    if isinstance(app.update_processor, PerUserUpdateProcessor):
+        metrics.gauge("bot_updates_pending", "Апдейты, которые ждут очереди пользователя или обрабатываются",
+                      lambda: app.update_processor.pending)
+    metrics.gauge("bot_sessions_in_memory", "Сессии пользователей в памяти", lambda: len(app.user_data))
+    metrics.gauge("flood_buckets", "Пользователи с неполным ведром антифлуда",
+                  lambda: sum(len(bucket) for bucket in app.bot_data["flood"].values()))
+    metrics.gauge("outbox_pending", "Недоставленные уведомления операторам", app.bot_data["outbox"].pending_count)
+
+def build_suggestions(tickets: TicketStore) -> Suggestions:
+    suggestions = Suggestions()
+    if not SUGGEST_LIMIT:
+        return suggestions
+    started = time.perf_counter()
+    catalog = suggestions.load_catalog(SUGGEST_CATALOG) if os.path.exists(SUGGEST_CATALOG) else 0
+    history = learn_history(suggestions, tickets)
+    logger.info("Подсказки: %d из каталога, %d из заявок за %.2fс", catalog, history, time.perf_counter() - started)
+    return suggestions
+
+def flood_buckets() -> dict:
+    limits = {
+        "callback": (FLOOD_CALLBACK_RATE, FLOOD_CALLBACK_BURST),
+        "message": (FLOOD_MESSAGE_RATE, FLOOD_MESSAGE_BURST),
+        "forward": (FLOOD_FORWARD_RATE, FLOOD_FORWARD_BURST),
+    }
+    return {kind: TokenBucket(rate, burst) for kind, (rate, burst) in limits.items() if rate > 0}
+
+async def post_init(app):
+    shard = app.bot_data["shard"]
+    if not shard:
+        # Один отправщик на все обработчики: лимиты чата операторов общие
+        sender = OutboxSender(app.bot_data["outbox"], app.bot, chat_interval=OUTBOX_CHAT_INTERVAL,
+                              global_rate=OUTBOX_GLOBAL_RATE,
+                              on_sent=functools.partial(remember_relay, app.bot_data["relay"]),
+                              digest=functools.partial(operator_digest, app.bot_data["tickets"]) if DIGEST_THRESHOLD else None,
+                              digest_threshold=DIGEST_THRESHOLD, digest_size=DIGEST_SIZE,
+                              poll=OUTBOX_POLL if shard is not None else None)
+        sender.start()
+        app.bot_data["outbox_sender"] = sender
+    await app.bot_data["metrics"].start(METRICS_LISTEN, METRICS_PORT + (shard or 0))
+
+async def post_stop(app):
+    # Останавливаем до закрытия соединений бота; недоставленное останется в outbox
+    sender = app.bot_data.pop("outbox_sender", None)
+    if sender:
+        await sender.stop()
+    await app.bot_data["metrics"].stop()
+
+async def post_shutdown(app):
+    app.bot_data["outbox"].close()
+    app.bot_data["tickets"].close()
+    app.bot_data["relay"].close()
+
+def build_app(shard: int = None):
+    # shard — номер процесса-обработчика при SHARDS > 1: апдейты тогда приносит приёмник
+    pool = dict(
+        keepalive_expiry=BOT_API_KEEPALIVE,
+        connection_pool_size=BOT_API_POOL_SIZE,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
     )
-    app.add_handler(repair_conv)
-    
-    # Курьер
-    courier_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(courier_start, pattern="^courier$")],
-        states={
-            COURIER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, courier_name)],
-            COURIER_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, courier_phone)],
-            COURIER_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, courier_type)],
-            COURIER_BRAND: [MessageHandler(filters.TEXT & ~filters.COMMAND, courier_brand)],
-            COURIER_MODEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, courier_model)],
-            COURIER_DIMENSIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, courier_dimensions)],
-            COURIER_ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, courier_address)],
-            COURIER_CONFIRM: [CallbackQueryHandler(courier_confirm, pattern="^(confirm|cancel)$")],
-        },
-        fallbacks=[CallbackQueryHandler(cancel, pattern="^cancel$")],
-        conversation_timeout=900,
+    if METRICS_PORT:
+        metrics = Metrics()
+        if PROFILE_INTERVAL:
+            metrics.profiler = SamplingProfiler(PROFILE_INTERVAL, PROFILE_PATH)
+        request = MeteredRequest(metrics, **pool)
+    else:
+        metrics = NullMetrics()
+        request = KeepAliveRequest(**pool)
+
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .request(request)
+        .update_queue(BoundedUpdateQueue(UPDATE_QUEUE_SIZE, UPDATE_QUEUE_SIZE))
+        .context_types(ContextTypes(user_data=UserData))
+        .persistence(SQLitePersistence(PERSISTENCE_PATH, update_interval=PERSISTENCE_INTERVAL))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
     )
-    app.add_handler(courier_conv)
+    if shard is not None:
+        builder = builder.updater(None)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, UPDATE_QUEUE_SIZE))
+    app = builder.build()
+    app.bot_data["shard"] = shard
+    app.bot_data["outbox"] = Outbox(OUTBOX_PATH)
+    app.bot_data["tickets"] = TicketStore(TICKETS_PATH)
+    app.bot_data["relay"] = RelayIndex(RELAY_PATH, RELAY_CACHE)
+    app.bot_data["suggestions"] = build_suggestions(app.bot_data["tickets"])
+    app.bot_data["recent_tickets"] = RecentTickets(DEDUP_WINDOW) if DEDUP_WINDOW else None
+    app.bot_data["metrics"] = metrics
+    app.bot_data["flood"] = flood_buckets()
+    app.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+
+    # Антифлуд и отметка активности — до всех остальных обработчиков
+    app.add_handler(TypeHandler(Update, flood_guard), group=-2)
+    app.add_handler(TypeHandler(Update, touch_session), group=-1)
     
-    # Картриджи
-    cartridge_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(cartridge_start, pattern="^cartridge$")],
-        states={
-            CARTRIDGE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, cartridge_name)],
-            CARTRIDGE_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, cartridge_phone)],
-            CARTRIDGE_BRAND: [MessageHandler(filters.TEXT & ~filters.COMMAND, cartridge_brand)],
-            CARTRIDGE_MODEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, cartridge_model)],
-            CARTRIDGE_CARTRIDGE_MODEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, cartridge_cartridge_model)],
-            CARTRIDGE_ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, cartridge_address)],
-            CARTRIDGE_CONFIRM: [CallbackQueryHandler(cartridge_confirm, pattern="^(confirm|cancel)$")],
-        },
-        fallbacks=[CallbackQueryHandler(cancel, pattern="^cancel$")],
-        conversation_timeout=900,
-    )
-    app.add_handler(cartridge_conv)
+    # Заявки: ремонт + sysadmin, курьер, картриджи
+    for flow in FLOWS:
+        app.add_handler(form_conversation(flow))
     
-    # Сообщения оператору (кроме диалогов)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, forward_manager))
+    # Кнопки вне диалогов: общие и статические. После диалогов — «Отмена» посреди формы
+    # разбирает сам диалог и завершает его; здесь она только для переписки и старых кнопок
+    app.add_handler(CallbackRouter({
+        "cancel": cancel,
+        "main": main_menu,
+        "contacts": contacts_handler,
+        "social": social_handler,
+        "manager": manager_handler,
+        "tickets": tickets_next_page,
+        "status": status_button,
+        "reply": reply_button,
+    }))
     
-    # Старт
-    app.add_handler(CommandHandler("start", lambda u, c: main_menu(u, c)))
+    # Ответы операторов клиентам
+    app.add_handler(MessageHandler(filters.Chat(OPERATOR_CHAT_ID) & filters.REPLY & ~filters.COMMAND, relay_reply))
+
+    # Сообщения оператору (кроме диалогов): текст и всё, что можно скопировать
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & (filters.TEXT | RELAY_MEDIA) & ~filters.COMMAND,
+                                   forward_manager))
     
-    logger.info("Бот запущен 🚀")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Старт
+    app.add_handler(CommandHandler("start", main_menu))
+
+    # Команды операторов — только в их чате
+    operators = filters.Chat(OPERATOR_CHAT_ID)
+    app.add_handler(CommandHandler("find", find_tickets, filters=operators))
+    app.add_handler(CommandHandler("open", open_tickets, filters=operators))
+    app.add_handler(CommandHandler("status", set_ticket_status, filters=operators))
+    app.add_handler(CommandHandler("stats", show_stats, filters=operators))
+
+    if metrics:
+        metrics.instrument([handler for handlers in app.handlers.values() for handler in handlers], handler_name)
+        register_gauges(app, metrics)
+    return app
+
+def run_shard(shard: int, count: int, updates, ready):
+    # Тело процесса-обработчика (см. shards.py)
+    shards.ignore_signals()
+    asyncio.run(serve_shard(shard, count, updates, ready))
+
+async def serve_shard(shard: int, count: int, updates, ready):
+    app = build_app(shard)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    ready.put(allowed_updates(app))
+    logger.info("Обработчик %d из %d запущен", shard + 1, count)
+    try:
+        await shards.feed(app, updates)
+    finally:
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+def main():
+    if SHARDS > 1:
+        webhook = None
+        if BOT_MODE == "webhook":
+            webhook = dict(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH, url=WEBHOOK_URL,
+                           secret=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        shards.serve(run_shard, SHARDS, BOT_API_URL, BOT_TOKEN, webhook)
+        return
+    app = build_app()
+    updates = allowed_updates(app)
+    logger.info("Бот запущен 🚀 (%s, апдейты: %s)", BOT_MODE, ", ".join(updates))
+    if BOT_MODE == "webhook":
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=updates,
+        )
+    else:
+        app.run_polling(allowed_updates=updates)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,288 @@
+# ==========================
+# Метрики для Prometheus и выборочный профилировщик
+#
+# Включаются только при METRICS_PORT: тогда обработчики оборачиваются
+# замером времени, запросы к Bot API считаются по методам, а на
+# http://METRICS_LISTEN:METRICS_PORT/metrics отдаётся текстовый формат
+# Prometheus. Выключенные метрики — NullMetrics: ничего не оборачивается,
+# вызовы inc/observe из обработчиков ничего не делают.
+# ==========================
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import ApplicationHandlerStop, BaseHandler, ConversationHandler
+
+from replies import KeepAliveRequest
+from router import CallbackRouter
+
+logger = logging.getLogger(__name__)
+
+# Секунды: от быстрых ответов из памяти до долгих ретраев Bot API
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTERS = {
+    "bot_handler_errors_total": ("Исключения в обработчиках", ("handler",)),
+    "bot_api_errors_total": ("Ошибки вызовов Bot API", ("method", "error")),
+    "bot_api_retry_after_seconds_total": ("Сколько секунд Telegram просил подождать (429)", ("method",)),
+    "form_steps_total": ("Сколько раз пользователи доходили до шага формы", ("flow", "step")),
+    "form_exits_total": ("Выходы из формы без отправки: на каком шаге и почему", ("flow", "step", "reason")),
+    "flood_dropped_total": ("Апдейты, отброшенные антифлудом", ("kind",)),
+    "form_suggest_total": ("Подсказки: exact — известное значение, picked — кнопкой, kept — оставлено как написано, none — нечего подсказать", ("kind", "result")),
+    "form_duplicates_total": ("Повторные заявки: merged — не отправлены, flagged — помечены", ("flow", "kind")),
+}
+
+HISTOGRAMS = {
+    "bot_handler_seconds": ("Время обработчика", ("handler",)),
+    "bot_api_request_seconds": ("Время вызова Bot API", ("method",)),
+    "event_loop_lag_seconds": ("Опоздание event loop относительно расписания", ()),
+}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metrics:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self._counters = {name: {} for name in COUNTERS}  # имя -> {метки: значение}
+        self._histograms = {name: {} for name in HISTOGRAMS}  # имя -> {метки: [по корзинам..., сумма, число]}
+        self._gauges = {}  # имя -> (описание, функция без аргументов)
+        self._server = None
+        self._lag_task = None
+        self.profiler = None
+
+    def __bool__(self):
+        return True
+
+    def inc(self, name: str, *labels, value: float = 1):
+        values = self._counters[name]
+        values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name: str, seconds: float, *labels):
+        values = self._histograms[name]
+        row = values.get(labels)
+        if row is None:
+            row = values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                row[i] += 1
+                break
+        else:
+            row[len(self.buckets)] += 1
+        row[-2] += seconds
+        row[-1] += 1
+
+    def gauge(self, name: str, help_text: str, read):
+        # read() вызывается при каждом запросе /metrics
+        self._gauges[name] = (help_text, read)
+
+    def render(self) -> str:
+        lines = []
+        for name, (help_text, names) in COUNTERS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_labels(names, labels)} {value}" for labels, value in self._counters[name].items()]
+        for name, (help_text, names) in HISTOGRAMS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for labels, row in self._histograms[name].items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), row):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels((*names, 'le'), (*labels, bound))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(names, labels)} {row[-2]}")
+                lines.append(f"{name}_count{_labels(names, labels)} {row[-1]}")
+        for name, (help_text, read) in self._gauges.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {read()}"]
+        return "\n".join(lines) + "\n"
+
+    # --- обработчики ---
+
+    def timed(self, name: str, callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                # Не ошибка: так обработчик (например, антифлуд) останавливает остальные группы
+                raise
+            except Exception:
+                self.inc("bot_handler_errors_total", name)
+                raise
+            finally:
+                self.observe("bot_handler_seconds", time.perf_counter() - started, name)
+        return wrapper
+
+    def instrument(self, handlers, name_of):
+        # Оборачивает колбэки обработчиков, включая вложенные в диалоги и маршрутизаторы;
+        # name_of(callback) -> имя для метки handler
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                nested = list(handler.entry_points) + list(handler.fallbacks)
+                for state_handlers in handler.states.values():
+                    nested.extend(state_handlers)
+                self.instrument(nested, name_of)
+            elif isinstance(handler, CallbackRouter):
+                handler.routes = {data: self.timed(name_of(callback), callback)
+                                  for data, callback in handler.routes.items()}
+            elif isinstance(handler, BaseHandler):
+                handler.callback = self.timed(name_of(handler.callback), handler.callback)
+
+    # --- сервер и фоновые замеры ---
+
+    async def start(self, host: str, port: int, loop_interval: float = 0.5):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        self._lag_task = asyncio.create_task(self._watch_loop(loop_interval), name="metrics_loop_lag")
+        if self.profiler:
+            self.profiler.start()
+        logger.info("Метрики: http://%s:%s/metrics", host, port)
+
+    async def stop(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.profiler:
+            self.profiler.stop()
+
+    async def _watch_loop(self, interval: float):
+        # Если обработчик надолго занял поток, пробуждение опоздает — это и меряем
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.observe("event_loop_lag_seconds", max(0.0, time.perf_counter() - started - interval))
+
+    async def _serve(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request.split()
+            path = parts[1].decode() if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, body = "200 OK", self.render()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/profile" and self.profiler:
+                status, body = "200 OK", self.profiler.folded()
+                content_type = "text/plain; charset=utf-8"
+            else:
+                status, body, content_type = "404 Not Found", "not found\n", "text/plain"
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class NullMetrics:
+    # Метрики выключены: те же методы, ничего не считают
+    profiler = None
+
+    def __bool__(self):
+        return False
+
+    def inc(self, name, *labels, value=1):
+        pass
+
+    def observe(self, name, seconds, *labels):
+        pass
+
+    def gauge(self, name, help_text, read):
+        pass
+
+    def instrument(self, handlers, name_of):
+        pass
+
+    async def start(self, host, port, loop_interval=0.5):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class MeteredRequest(KeepAliveRequest):
+    # Время, ошибки и 429 по каждому методу Bot API
+    def __init__(self, metrics: Metrics, **kwargs):
+        self._metrics = metrics
+        super().__init__(**kwargs)
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except RetryAfter as exc:
+            self._metrics.inc("bot_api_errors_total", method, "RetryAfter")
+            self._metrics.inc("bot_api_retry_after_seconds_total", method, value=exc.retry_after)
+            raise
+        except TelegramError as exc:
+            self._metrics.inc("bot_api_errors_total", method, type(exc).__name__)
+            raise
+        finally:
+            self._metrics.observe("bot_api_request_seconds", time.perf_counter() - started, method)
+
+
+class SamplingProfiler:
+    # Раз в interval секунд отдельный поток снимает стек потока с event loop.
+    # Стеки копятся в свёрнутом виде («a;b;c число») — его понимают
+    # flamegraph.pl и speedscope. На сам event loop почти не влияет.
+    def __init__(self, interval: float, path: str = ""):
+        self.interval = interval
+        self.path = path  # куда записать при остановке
+        self.stacks = Counter()
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Вызывать из потока event loop — его и профилируем
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling_profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        if self.path:
+            with open(self.path, "w", encoding="utf-8") as out:
+                out.write(self.folded())
+            logger.info("Профиль: %d стеков записано в %s", len(self.stacks), self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
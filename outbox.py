@@ -0,0 +1,271 @@
+# ==========================
+# Исходящая очередь уведомлений операторам
+#
+# Обработчик только записывает сообщение в локальный SQLite (WAL) и сразу
+# отвечает клиенту. Фоновый отправщик вычитывает очередь по порядку, держит
+# лимиты Telegram (на чат и общий) и повторяет отправку с экспоненциальной
+# задержкой, пока Telegram не примет сообщение. Доставка «как минимум
+# один раз»: строка помечается отправленной только после ответа Telegram,
+# повторная постановка с тем же ключом игнорируется.
+#
+# Сводки: в чат операторов Telegram пускает ~20 сообщений в минуту. Пока
+# чат ждёт своей очереди, уведомления в него копятся; если к моменту
+# отправки их набралось digest_threshold и больше, они уходят одним
+# сообщением (до digest_size штук). Схлынула нагрузка — снова по одному.
+#
+# Вложения: строка может нести фото и документы — только их file_id. Они
+# уходят альбомом (sendMediaGroup) или одним sendPhoto/sendDocument, сами
+# файлы бот не скачивает и не загружает заново. Или копию сообщения клиента
+# (copyMessage: чат и message_id) — голосовое, видео, стикер доходят как есть.
+# ==========================
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from telegram import InputMediaDocument, InputMediaPhoto
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+PENDING, SENT, DEAD = 0, 1, 2
+
+MESSAGE_LIMIT = 4096  # символов в одном сообщении Telegram
+CAPTION_LIMIT = 1024  # символов в подписи к файлу
+ALBUM_LIMIT = 10  # файлов в одном sendMediaGroup
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    media TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, id);
+"""
+
+
+class Outbox:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        if "media" not in {row[1] for row in self.db.execute("PRAGMA table_info(outbox)")}:
+            self.db.execute("ALTER TABLE outbox ADD COLUMN media TEXT")  # база до появления вложений
+        self.wakeup = asyncio.Event()
+
+    def put(self, key: str, chat_id: int, text: str, media: list = None) -> bool:
+        # media: [[вид, file_id], ...] из media_groups(); text тогда — подпись
+        now = time.time()
+        cur = self.db.execute(
+            "INSERT OR IGNORE INTO outbox (key, chat_id, text, next_at, created_at, media) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, chat_id, text, now, now, json.dumps(media) if media else None),
+        )
+        self.wakeup.set()
+        return cur.rowcount == 1
+
+    def pending(self, limit: int = 100) -> list:
+        return self.db.execute(
+            "SELECT id, key, chat_id, text, attempts, next_at, media FROM outbox WHERE status = ? ORDER BY id LIMIT ?",
+            (PENDING, limit),
+        ).fetchall()
+
+    def pending_count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (PENDING,)).fetchone()[0]
+
+    def mark_sent(self, row_id: int):
+        self.db.execute("UPDATE outbox SET status = ? WHERE id = ?", (SENT, row_id))
+
+    def mark_dead(self, row_id: int):
+        self.db.execute("UPDATE outbox SET status = ? WHERE id = ?", (DEAD, row_id))
+
+    def retry_later(self, row_id: int, attempts: int, next_at: float):
+        self.db.execute("UPDATE outbox SET attempts = ?, next_at = ? WHERE id = ?", (attempts, next_at, row_id))
+
+    def close(self):
+        self.db.close()
+
+
+# вид вложения → (метод бота для одного файла, элемент альбома)
+MEDIA = {
+    "photo": ("send_photo", InputMediaPhoto),
+    "document": ("send_document", InputMediaDocument),
+}
+
+
+# Вложение-копия: [COPY, чат клиента, message_id]; text строки — новая подпись (пусто — оставить свою)
+COPY = "copy"
+
+
+def media_groups(media: list) -> list:
+    # Фото и документы в одном альбоме Telegram не смешивает; в альбоме до ALBUM_LIMIT файлов
+    groups = []
+    for kind in MEDIA:
+        files = [item for item in media if item[0] == kind]
+        groups += [files[i:i + ALBUM_LIMIT] for i in range(0, len(files), ALBUM_LIMIT)]
+    return groups
+
+
+class OutboxSender:
+    def __init__(self, outbox: Outbox, bot, chat_interval: float = 3.0, global_rate: float = 30.0,
+                 backoff_base: float = 1.0, backoff_max: float = 300.0, on_sent=None,
+                 digest=None, digest_threshold: int = 3, digest_size: int = 10, poll: float = None):
+        self.outbox = outbox
+        self.bot = bot
+        self.on_sent = on_sent  # on_sent(key, message) — после того как Telegram принял сообщение (не сводку)
+        self.digest = digest  # digest([(key, text)]) -> (текст, reply_markup); None — сводки выключены
+        self.digest_threshold = digest_threshold
+        self.digest_size = digest_size
+        self.poll = poll  # очередь пополняют и другие процессы: заглядывать в неё хотя бы так часто, с
+        self.chat_interval = chat_interval  # в группу — не чаще ~20 сообщений в минуту
+        self.global_interval = 1 / global_rate if global_rate else 0.0  # ~30 сообщений в секунду на бота
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._chat_ready_at = {}  # chat_id -> когда можно слать следующее
+        self._global_ready_at = 0.0
+        self._single = set()  # строки, чья сводка не прошла — шлём по одной
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run(), name="outbox_sender")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        failures = 0
+        while True:
+            self.outbox.wakeup.clear()
+            try:
+                wait = await self.drain()
+                failures = 0
+            except Exception:
+                # Отправщик не должен умирать: неожиданная ошибка (база занята другим
+                # процессом, отозванный токен, ошибка в коде) — в лог и повтор с паузой
+                failures += 1
+                wait = min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+                logger.exception("Outbox: сбой отправки, повтор через %.0fс", wait)
+            if self.poll:
+                wait = self.poll if wait is None else min(wait, self.poll)
+            try:
+                await asyncio.wait_for(self.outbox.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self, batch: int = 100):
+        # Отправляет всё, что уже можно; возвращает, сколько ждать до следующей попытки
+        blocked = set()  # чаты, где сообщение отложено: следующие за ним не обгоняют его
+        handled = set()  # строки, уже ушедшие (или отложенные) в составе сводки
+        wait = None
+        while True:
+            rows = self.outbox.pending(batch)
+            for index, (row_id, key, chat_id, text, attempts, next_at, media) in enumerate(rows):
+                if chat_id in blocked or row_id in handled:
+                    continue
+                delay = next_at - time.time()
+                if delay <= 0 and self.digest:
+                    # Не ждём лимита чата здесь: пока ждём, копится сводка
+                    delay = self._chat_ready_at.get(chat_id, 0.0) - time.monotonic()
+                if delay <= 0:
+                    group, text, markup = self._group(rows, index)
+                    handled.update(row[0] for row in group)
+                    delay = await self._send(group, text, markup)
+                if delay is not None:
+                    blocked.add(chat_id)
+                    wait = delay if wait is None else min(wait, delay)
+            if len(rows) < batch or blocked:
+                return wait
+
+    def _group(self, rows: list, index: int):
+        # Строка rows[index] и готовые следующие за ней в тот же чат: (строки, текст, кнопки)
+        head = rows[index]
+        if not self.digest or head[0] in self._single or head[6]:
+            return [head], head[3], None
+        now = time.time()
+        group = []
+        for row in rows[index:]:
+            if row[2] != head[2]:
+                continue
+            if row[5] > now or row[0] in self._single or row[6] or len(group) == self.digest_size:
+                break
+            group.append(row)
+        while len(group) >= self.digest_threshold:
+            text, markup = self.digest([(row[1], row[3]) for row in group])
+            if len(text) <= MESSAGE_LIMIT:
+                return group, text, markup
+            group.pop()
+        return [head], head[3], None
+
+    async def _send(self, rows: list, text: str, reply_markup=None):
+        # Одно сообщение за строки rows; возвращает задержку, если оно отложено
+        chat_id = rows[0][2]
+        media = json.loads(rows[0][6]) if rows[0][6] else None
+        # Альбом Telegram считает за столько сообщений, сколько в нём файлов
+        await self._pace(chat_id, len(media) if media else 1)
+        try:
+            messages = await self._deliver(chat_id, text, media, reply_markup)
+        except RetryAfter as exc:
+            delay = exc.retry_after
+            logger.warning("Outbox: RetryAfter %sс для чата %s", delay, chat_id)
+            self._chat_ready_at[chat_id] = time.monotonic() + delay
+            for row in rows:
+                self.outbox.retry_later(row[0], row[4], time.time() + delay)
+            return delay
+        except (BadRequest, Forbidden, ChatMigrated) as exc:
+            if len(rows) > 1:
+                logger.error("Outbox: сводка не принята в %s (%s), отправим по одному", chat_id, exc)
+                self._single.update(row[0] for row in rows)
+                return 0.0
+            # Повтор не поможет — откладываем в сторону, чтобы не держать очередь
+            logger.error("Outbox: сообщение %s не может быть доставлено в %s: %s", rows[0][0], chat_id, exc)
+            self.outbox.mark_dead(rows[0][0])
+            self._single.discard(rows[0][0])
+            return None
+        except NetworkError as exc:
+            attempts = max(row[4] for row in rows) + 1
+            delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+            logger.warning("Outbox: ошибка сети (%s), повтор через %.0fс", exc, delay)
+            for row in rows:
+                self.outbox.retry_later(row[0], attempts, time.time() + delay)
+            return delay
+        for row in rows:
+            self.outbox.mark_sent(row[0])
+            self._single.discard(row[0])
+        if self.on_sent and len(rows) == 1:
+            for message in messages:
+                self.on_sent(rows[0][1], message)
+        return None
+
+    async def _deliver(self, chat_id: int, text: str, media: list, reply_markup) -> list:
+        if not media:
+            return [await self.bot.send_message(chat_id, text, reply_markup=reply_markup)]
+        if media[0][0] == COPY:
+            _, from_chat_id, message_id = media[0]
+            return [await self.bot.copy_message(chat_id, from_chat_id, message_id, caption=text or None)]
+        if len(media) == 1:
+            kind, file_id = media[0]
+            return [await getattr(self.bot, MEDIA[kind][0])(chat_id, file_id, caption=text)]
+        album = [MEDIA[kind][1](file_id, caption=text if i == 0 else None) for i, (kind, file_id) in enumerate(media)]
+        return list(await self.bot.send_media_group(chat_id, album))
+
+    async def _pace(self, chat_id: int, count: int = 1):
+        now = time.monotonic()
+        ready_at = max(self._chat_ready_at.get(chat_id, 0.0), self._global_ready_at)
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+            now = ready_at
+        self._chat_ready_at[chat_id] = now + self.chat_interval * count
+        self._global_ready_at = now + self.global_interval * count
@@ -0,0 +1,183 @@
+# ==========================
+# Хранение диалогов и user_data в SQLite
+#
+# Application сам раз в update_interval отдаёт сюда только изменившиеся
+# записи; здесь они копятся в памяти и пишутся одной транзакцией — сразу
+# после очередного прохода Application или раньше, если набралось
+# flush_threshold изменений. user_data не читается целиком при старте:
+# запись пользователя подгружается при его первом апдейте после запуска.
+# user_data — объект с методами to_dict() и load(dict) (см. sessions.py).
+# ==========================
+import asyncio
+import json
+import sqlite3
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+_DELETED = object()
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, path: str, update_interval: float = 5, flush_threshold: int = 500):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.flush_threshold = flush_threshold
+        self._db = None
+        self._loaded_users = set()
+        self._dirty_users = {}  # user_id -> данные или _DELETED
+        self._dirty_conversations = {}  # (name, key) -> состояние или _DELETED
+        self._flush_scheduled = False
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(conversations)")}
+            if "updated_at" not in columns:
+                # База до появления updated_at: считаем, что диалоги менялись сейчас
+                self._db.execute("ALTER TABLE conversations ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+                self._db.execute("UPDATE conversations SET updated_at = ?", (time.time(),))
+        return self._db
+
+    # --- загрузка ---
+
+    async def get_user_data(self):
+        # Пусто: данные подтягиваются по одному в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        if user_id in self._dirty_users:
+            return
+        row = self.db.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        if row and not user_data:
+            user_data.load(json.loads(row[0]))
+
+    async def get_conversations(self, name):
+        # Живых диалогов немного (закрытые и брошенные удаляются), их читаем сразу.
+        # Тайм-аут PTB для них после запуска не взводится — их снимает drop_stale
+        rows = self.db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- запись ---
+
+    async def update_user_data(self, user_id, data):
+        self._loaded_users.add(user_id)
+        self._dirty_users[user_id] = data if data else _DELETED
+        self._mark_dirty()
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        self._dirty_users[user_id] = _DELETED
+        self._mark_dirty()
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty_conversations[(name, key)] = _DELETED if new_state is None else new_state
+        self._mark_dirty()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    def _mark_dirty(self):
+        if len(self._dirty_users) + len(self._dirty_conversations) >= self.flush_threshold:
+            self._write()
+        elif not self._flush_scheduled:
+            # Application передаёт изменения пачкой через gather — пишем после всей пачки
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._write)
+
+    def _write(self):
+        self._flush_scheduled = False
+        if not (self._dirty_users or self._dirty_conversations):
+            return
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        now = time.time()
+        db = self.db
+        with db:
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                [(uid, json.dumps(data.to_dict(), ensure_ascii=False), now)
+                 for uid, data in users.items() if data is not _DELETED],
+            )
+            db.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(uid,) for uid, data in users.items() if data is _DELETED],
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)",
+                [(name, json.dumps(key), json.dumps(state), now)
+                 for (name, key), state in conversations.items() if state is not _DELETED],
+            )
+            db.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, json.dumps(key)) for (name, key), state in conversations.items() if state is _DELETED],
+            )
+
+    def drop_stale(self, before: float):
+        # Удаляет записи, которые не менялись с before; возвращает число user_data
+        # и список удалённых диалогов (имя, ключ) — их надо снять и в памяти
+        self._write()
+        db = self.db
+        with db:
+            db.execute("BEGIN")
+            users = db.execute("DELETE FROM user_data WHERE updated_at < ?", (before,)).rowcount
+            conversations = db.execute(
+                "DELETE FROM conversations WHERE updated_at < ? RETURNING name, key", (before,)
+            ).fetchall()
+        return users, [(name, tuple(json.loads(key))) for name, key in conversations]
+
+    async def flush(self):
+        self._write()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
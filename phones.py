@@ -0,0 +1,28 @@
+# ==========================
+# Номера телефонов → E.164
+#
+# Клиенты пишут как удобно: 0501234567, +380501234567, 050 123 45 67,
+# (050)123-45-67, 8 050 ... — всё это один номер +380501234567. Один
+# нормализатор на все формы и на поиск операторов; выражения собраны
+# один раз при импорте.
+# ==========================
+import re
+
+# Всё, кроме цифр и плюса: пробелы, скобки, дефисы, точки, «тел.» и т.п.
+_JUNK = re.compile(r"[^\d+]+")
+# Украина: 9 цифр номера после 0, 80, 380 или +380 (или вовсе без префикса)
+_UA = re.compile(r"(?:\+?380|80|0)?([1-9]\d{8})")
+# Иностранные номера принимаем только в международном виде
+_INTERNATIONAL = re.compile(r"\+([1-9]\d{7,14})")
+
+
+def normalize_phone(text: str):
+    # E.164 (+380501234567) или None, если это не номер
+    compact = _JUNK.sub("", text)
+    match = _UA.fullmatch(compact)
+    if match:
+        return "+380" + match.group(1)
+    match = _INTERNATIONAL.fullmatch(compact)
+    if match:
+        return "+" + match.group(1)
+    return None
@@ -0,0 +1,66 @@
+# ==========================
+# Переписка клиента с операторами через бота
+#
+# Сообщение клиента уходит в чат операторов; чтобы ответ оператора
+# (reply на это сообщение) вернулся нужному клиенту, запоминаем
+# message_id в чате операторов → chat_id клиента. Последние записи
+# держим в памяти (LRU на capacity штук), все — в SQLite: после
+# перезапуска или для старого сообщения запись подтягивается с диска.
+# Записи старше prune(before) удаляются, так что не растёт и диск.
+# ==========================
+import sqlite3
+import time
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS relay (
+    message_id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS relay_created ON relay (created_at);
+"""
+
+
+class RelayIndex:
+    def __init__(self, path: str, capacity: int = 10000):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.capacity = capacity
+        self._cache = OrderedDict()  # message_id -> chat_id, недавно использованные в конце
+
+    def remember(self, message_id: int, chat_id: int):
+        self.db.execute(
+            "INSERT OR REPLACE INTO relay (message_id, chat_id, created_at) VALUES (?, ?, ?)",
+            (message_id, chat_id, time.time()),
+        )
+        self._cache_put(message_id, chat_id)
+
+    def lookup(self, message_id: int):
+        chat_id = self._cache.get(message_id)
+        if chat_id is not None:
+            self._cache.move_to_end(message_id)
+            return chat_id
+        row = self.db.execute("SELECT chat_id FROM relay WHERE message_id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None
+        self._cache_put(message_id, row[0])
+        return row[0]
+
+    def _cache_put(self, message_id: int, chat_id: int):
+        self._cache[message_id] = chat_id
+        self._cache.move_to_end(message_id)
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    def prune(self, before: float) -> int:
+        # В памяти старые записи вытеснятся сами; здесь чистим диск
+        return self.db.execute("DELETE FROM relay WHERE created_at < ?", (before,)).rowcount
+
+    def __len__(self):
+        return len(self._cache)
+
+    def close(self):
+        self.db.close()
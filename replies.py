@@ -0,0 +1,73 @@
+# ==========================
+# Ответы бота: меньше запросов к Bot API
+#
+# Обработчик не ждёт каждый вызов по очереди, а складывает их в Replies и
+# отправляет разом. Подряд идущие правки одного сообщения схлопываются в
+# последнюю (клиент всё равно видит только её), вызовы в разные чаты и
+# ответ на нажатие кнопки идут одновременно, а в пределах одного чата
+# порядок сохраняется.
+# ==========================
+import asyncio
+
+import httpx
+from telegram.request import HTTPXRequest
+
+
+class Replies:
+    __slots__ = ("_lanes",)
+
+    def __init__(self):
+        self._lanes = {}  # очередь -> [(метка для схлопывания, функция, аргументы)]
+
+    def _add(self, lane, tag, func, *args, **kwargs):
+        calls = self._lanes.setdefault(lane, [])
+        if tag is not None and calls and calls[-1][0] == tag:
+            calls[-1] = (tag, func, args, kwargs)
+        else:
+            calls.append((tag, func, args, kwargs))
+
+    def answer(self, query, text: str = None):
+        # Ответ на нажатие ни с чем не упорядочен — своя очередь
+        self._add(("answer", query.id), None, query.answer, text)
+
+    def edit(self, message, text: str, reply_markup=None):
+        self._add(message.chat_id, ("edit", message.message_id), message.edit_text, text, reply_markup=reply_markup)
+
+    def reply(self, message, text: str, reply_markup=None):
+        self._add(message.chat_id, None, message.reply_text, text, reply_markup=reply_markup)
+
+    def send_message(self, bot, chat_id: int, text: str, reply_markup=None):
+        self._add(chat_id, None, bot.send_message, chat_id, text, reply_markup=reply_markup)
+
+    async def flush(self):
+        lanes, self._lanes = list(self._lanes.values()), {}
+        if len(lanes) == 1:
+            await self._run(lanes[0])
+            return
+        results = await asyncio.gather(*(self._run(calls) for calls in lanes), return_exceptions=True)
+        # Ошибку отдаём обработчику ошибок, но только когда отработали все очереди
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    @staticmethod
+    async def _run(calls):
+        for _, func, args, kwargs in calls:
+            await func(*args, **kwargs)
+
+
+class KeepAliveRequest(HTTPXRequest):
+    # httpx по умолчанию закрывает простаивающее соединение через 5 секунд, и
+    # при редких сообщениях почти каждый ответ начинался с нового TLS-рукопожатия
+    def __init__(self, keepalive_expiry: float, **kwargs):
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(**kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs["limits"]
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=self._keepalive_expiry,
+        )
+        return super()._build_client()
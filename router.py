@@ -0,0 +1,44 @@
+# ==========================
+# Маршрутизация нажатий кнопок по callback_data
+#
+# Вместо цепочки CallbackQueryHandler с регулярными выражениями — один
+# обработчик со словарём: точное значение callback_data или его префикс
+# до первого ":" (формат "раздел:действие:аргумент") → функция.
+# Работает и внутри ConversationHandler: один маршрутизатор на состояние.
+# ==========================
+from telegram import Update
+from telegram.ext import BaseHandler
+
+
+class CallbackRouter(BaseHandler):
+    __slots__ = ("routes",)
+
+    def __init__(self, routes: dict, block: bool = True):
+        super().__init__(self._unrouted, block=block)
+        self.routes = dict(routes)
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        data = update.callback_query.data
+        if data is None:
+            return None
+        callback = self.routes.get(data)
+        if callback is not None:
+            return callback, None
+        prefix, sep, rest = data.partition(":")
+        if sep:
+            callback = self.routes.get(prefix)
+            if callback is not None:
+                return callback, rest.split(":")
+        return None
+
+    async def handle_update(self, update, application, check_result, context):
+        callback, args = check_result
+        context.args = args
+        return await callback(update, context)
+
+    @staticmethod
+    async def _unrouted(update, context):
+        # Сюда не попадаем: check_update пропускает неизвестные кнопки
+        return None
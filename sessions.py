@@ -0,0 +1,61 @@
+# ==========================
+# Данные пользователя: компактные записи со слотами вместо словарей
+#
+# Пока клиент заполняет форму, её поля лежат в объекте формы нужного
+# типа; после подтверждения, отмены или простоя форма удаляется целиком.
+# ==========================
+import time
+
+EMPTY = "—"
+
+
+class Form:
+    __slots__ = ()
+    kind = ""
+
+    def __init__(self, **values):
+        for field in self.__slots__:
+            setattr(self, field, values.get(field, EMPTY))
+
+    def to_dict(self) -> dict:
+        data = {field: getattr(self, field) for field in self.__slots__}
+        data["kind"] = self.kind
+        return data
+
+
+# kind -> класс формы; заполняется описаниями форм (forms.py)
+FORMS = {}
+
+
+class UserData:
+    __slots__ = ("form", "chat_with_manager", "last_seen")
+
+    def __init__(self):
+        self.form = None
+        self.chat_with_manager = False
+        self.last_seen = time.time()
+
+    def __bool__(self):
+        # Пустые записи не храним
+        return self.form is not None or self.chat_with_manager
+
+    def clear(self):
+        self.form = None
+        self.chat_with_manager = False
+
+    def to_dict(self) -> dict:
+        return {
+            "form": self.form.to_dict() if self.form is not None else None,
+            "chat_with_manager": self.chat_with_manager,
+            "last_seen": self.last_seen,
+        }
+
+    def load(self, data: dict):
+        form = data.get("form")
+        if form:
+            form = dict(form)
+            form_cls = FORMS.get(form.pop("kind"))
+            # Формы услуги, которой больше нет, просто не восстанавливаем
+            self.form = form_cls(**form) if form_cls else None
+        self.chat_with_manager = data.get("chat_with_manager", False)
+        self.last_seen = data.get("last_seen", self.last_seen)
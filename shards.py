@@ -0,0 +1,269 @@
+# ==========================
+# Несколько процессов-обработчиков (SHARDS > 1)
+#
+# Polling нельзя разделить между процессами, поэтому апдейты принимает один
+# процесс-приёмник (getUpdates или webhook) и раздаёт их N обработчикам по
+# хешу пользователя на кольце (consistent hashing): все апдейты одного
+# пользователя попадают в один процесс, там и живёт его диалог.
+#
+# Сессии, заявки, outbox и relay — общие SQLite (WAL). Уведомления
+# операторам отправляет только обработчик №0: лимиты чата операторов
+# соблюдаются на всех, остальные лишь пишут в общий outbox.
+#
+# Смена числа обработчиков (resize, SIGUSR1 / SIGUSR2 приёмнику) —
+# остановить все (диалоги сбрасываются на диск), построить новое кольцо,
+# запустить заново. Переезжает ~1/N пользователей, их диалоги новый
+# обработчик читает из общей базы сессий. Апдейты на это время ждут.
+#
+# Упавший обработчик приёмник поднимает заново на той же очереди; упавший
+# при запуске — ошибка, приёмник останавливается.
+# ==========================
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+
+import httpx
+from telegram import Update
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as TornadoApp, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+REPLICAS = 100  # точек на кольце у каждого обработчика: ровнее делятся пользователи
+SUPERVISE_INTERVAL = 1.0  # как часто приёмник проверяет, живы ли обработчики, с
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    __slots__ = ("nodes", "_hashes", "_owners")
+
+    def __init__(self, nodes: int, replicas: int = REPLICAS):
+        points = sorted((_hash(f"shard-{node}:{i}"), node) for node in range(nodes) for i in range(replicas))
+        self.nodes = nodes
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node(self, key) -> int:
+        # Апдейты без пользователя и чата — обработчику №0
+        if key is None:
+            return 0
+        pos = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._owners[pos % len(self._owners)]
+
+
+def update_user(data: dict):
+    # Тот же ключ, что у PerUserUpdateProcessor: пользователь, иначе чат — но из сырого JSON
+    for field, payload in data.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+class RawBotAPI:
+    # Приёмнику не нужны объекты PTB: апдейты уходят обработчикам как пришли
+    def __init__(self, base_url: str, token: str):
+        self.url = f"{base_url}{token}"
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0))
+
+    async def call(self, method: str, **params):
+        while True:
+            response = await self._client.post(f"{self.url}/{method}", json=params)
+            body = response.json()
+            if body.get("ok"):
+                return body["result"]
+            retry_after = body.get("parameters", {}).get("retry_after")
+            if retry_after is None:
+                raise RuntimeError(f"{method}: {body.get('description')}")
+            await asyncio.sleep(retry_after)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class Ingress:
+    # target(номер, всего, очередь апдейтов, очередь готовности) — тело процесса-обработчика;
+    # готовый обработчик кладёт в очередь готовности свой allowed_updates
+    def __init__(self, target):
+        self.target = target
+        self.ring = None
+        self.allowed_updates = []
+        self._context = multiprocessing.get_context("spawn")
+        self._ready = self._context.Queue()
+        self._queues = []
+        self._workers = []
+        self._lock = asyncio.Lock()  # на время resize и перезапуска апдейты ждут
+
+    def _spawn(self, i: int, count: int):
+        worker = self._context.Process(target=self.target, args=(i, count, self._queues[i], self._ready),
+                                       name=f"shard-{i}", daemon=True)
+        worker.start()
+        return worker
+
+    async def _wait_ready(self, workers: list) -> list:
+        # Отчёты о готовности; обработчик, упавший до отчёта, — ошибка запуска, а не вечное ожидание
+        loop = asyncio.get_running_loop()
+        reports = []
+        while len(reports) < len(workers):
+            try:
+                reports.append(await loop.run_in_executor(None, self._ready.get, True, SUPERVISE_INTERVAL))
+            except queue.Empty:
+                dead = [worker for worker in workers if worker.exitcode is not None]
+                if dead:
+                    for worker in workers:
+                        worker.kill()
+                    raise RuntimeError(f"{dead[0].name} завершился при запуске (код {dead[0].exitcode})")
+        return reports
+
+    async def start(self, count: int):
+        self._queues = [self._context.Queue() for _ in range(count)]
+        self._workers = [self._spawn(i, count) for i in range(count)]
+        reports = await self._wait_ready(self._workers)
+        self.allowed_updates = sorted(set().union(*reports))
+        self.ring = HashRing(count)
+        logger.info("Обработчиков: %d", count)
+
+    async def supervise(self):
+        # Упавший обработчик перезапускается на той же очереди: апдейты его пользователей,
+        # разосланные, пока его не было, он дочитает. Не поднялся — приёмник останавливается
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            async with self._lock:
+                for i, worker in enumerate(self._workers):
+                    if worker.is_alive():
+                        continue
+                    logger.error("%s завершился (код %s), перезапускаем", worker.name, worker.exitcode)
+                    # Умерший мог держать блокировку чтения очереди (ждал в get): новому читателю — новая
+                    self._queues[i]._rlock = self._context.Lock()
+                    self._workers[i] = self._spawn(i, len(self._workers))
+                    await self._wait_ready([self._workers[i]])
+
+    async def stop(self):
+        # Обработчик доделывает свою очередь и сбрасывает диалоги на диск
+        for updates in self._queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in self._workers:
+            await loop.run_in_executor(None, worker.join)
+        self._queues, self._workers = [], []
+
+    async def resize(self, count: int):
+        async with self._lock:
+            old = self.ring
+            await self.stop()
+            await self.start(count)
+            logger.info("Обработчиков было %d, стало %d", old.nodes, count)
+
+    def route(self, updates: list):
+        batches = {}
+        for data in updates:
+            batches.setdefault(self.ring.node(update_user(data)), []).append(data)
+        for node, batch in batches.items():
+            self._queues[node].put(batch)
+
+    async def dispatch(self, updates: list):
+        async with self._lock:
+            self.route(updates)
+
+    async def poll(self, api: RawBotAPI, timeout: int = 10):
+        # Один long polling на всех; подтверждение — offset следующего запроса
+        await api.call("deleteWebhook")
+        offset = 0
+        while True:
+            try:
+                updates = await api.call("getUpdates", offset=offset, timeout=timeout,
+                                         allowed_updates=self.allowed_updates)
+            except (httpx.HTTPError, RuntimeError) as exc:
+                logger.warning("getUpdates: %s", exc)
+                await asyncio.sleep(1)
+                continue
+            if updates:
+                offset = updates[-1]["update_id"] + 1
+                await self.dispatch(updates)
+
+    async def serve_webhook(self, api: RawBotAPI, listen: str, port: int, url_path: str, url: str,
+                            secret: str, max_connections: int):
+        server = HTTPServer(TornadoApp([(rf"/{url_path}", _WebhookHandler, {"ingress": self, "secret": secret})]))
+        server.listen(port, listen)
+        await api.call("setWebhook", url=url, secret_token=secret, max_connections=max_connections,
+                       allowed_updates=self.allowed_updates)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.stop()
+
+
+class _WebhookHandler(RequestHandler):
+    def initialize(self, ingress: Ingress, secret: str):
+        self.ingress = ingress
+        self.secret = secret
+
+    async def post(self):
+        if self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            self.set_status(403)
+            return
+        await self.ingress.dispatch([json.loads(self.request.body)])
+
+
+async def feed(app, updates):
+    # В процессе-обработчике: апдейты от приёмника в очередь Application, пока не придёт None
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await loop.run_in_executor(None, updates.get)
+        if batch is None:
+            return
+        for data in batch:
+            await app.update_queue.put(Update.de_json(data, app.bot))
+
+
+def ignore_signals():
+    # Останавливает обработчики приёмник (через очередь), а не сигнал всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+async def _serve(target, count: int, base_url: str, token: str, webhook: dict = None):
+    api = RawBotAPI(base_url, token)
+    ingress = Ingress(target)
+    await ingress.start(count)
+    loop = asyncio.get_running_loop()
+    receiving = asyncio.create_task(ingress.serve_webhook(api, **webhook) if webhook else ingress.poll(api))
+    supervising = asyncio.create_task(ingress.supervise())
+    supervising.add_done_callback(lambda task: task.cancelled() or receiving.cancel())
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, receiving.cancel)
+    loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(ingress.resize(ingress.ring.nodes + 1)))
+    loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.create_task(ingress.resize(max(1, ingress.ring.nodes - 1))))
+    logger.info("Приёмник запущен 🚀 (%s, апдейты: %s)", "webhook" if webhook else "polling",
+                ", ".join(ingress.allowed_updates))
+    try:
+        await receiving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        supervising.cancel()
+        async with ingress._lock:
+            await ingress.stop()
+        await api.close()
+    try:
+        await supervising  # обработчик не поднялся после падения — ошибка наружу
+    except asyncio.CancelledError:
+        pass
+
+
+def serve(target, count: int, base_url: str, token: str, webhook: dict = None):
+    # webhook: listen, port, url_path, url, secret, max_connections; None — polling
+    asyncio.run(_serve(target, count, base_url, token, webhook))
@@ -0,0 +1,138 @@
+# ==========================
+# Статистика заявок по дням и выгрузка
+#
+# Счётчики ведутся при записи: отправленная заявка, отмена или брошенная
+# форма прибавляет единицу в строку (день, вид заявки, бренд, исход, шаг).
+# Отчёт за неделю — сумма нескольких сотен таких строк, история заявок
+# для него не перечитывается. Таблица лежит в базе заявок, так что
+# счётчик отправленных растёт в одной транзакции с записью заявки.
+#
+# Выгрузка (python stats.py daily|tickets) идёт генератором по курсору
+# SQLite и пишется в stdout построчно: память не зависит от объёма истории.
+# ==========================
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    brand TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    step TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, mode, brand, outcome, step)
+) WITHOUT ROWID;
+"""
+
+# Исход «заявка отправлена»; остальные — почему форму бросили (cancelled, timeout, idle)
+# или merged — повтор уже отправленной заявки
+DONE = "done"
+
+DAILY_COLUMNS = ("day", "mode", "brand", "outcome", "step", "count")
+TICKET_COLUMNS = ("id", "created", "flow", "mode", "status", "brand")
+
+
+def day_of(timestamp: float = None) -> str:
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+
+class DailyStats:
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.db.executescript(SCHEMA)
+
+    def add(self, mode: str, brand: str, outcome: str, step: str = "", when: float = None):
+        self.db.execute(
+            "INSERT INTO daily_stats (day, mode, brand, outcome, step, count) VALUES (?, ?, ?, ?, ?, 1)"
+            " ON CONFLICT (day, mode, brand, outcome, step) DO UPDATE SET count = count + 1",
+            (day_of(when), mode, brand, outcome, step),
+        )
+
+    def summary(self, since: str) -> dict:
+        # Всё для отчёта одним проходом по счётчикам начиная с дня since
+        done, exits, steps, brands, days = Counter(), Counter(), Counter(), Counter(), Counter()
+        for day, mode, brand, outcome, step, count in self.db.execute(
+            f"SELECT {', '.join(DAILY_COLUMNS)} FROM daily_stats WHERE day >= ?", (since,)
+        ):
+            if outcome == DONE:
+                done[mode] += count
+                brands[brand] += count
+                days[day] += count
+            else:
+                exits[outcome] += count
+                if step:
+                    steps[mode, step] += count
+        return {"done": done, "exits": exits, "steps": steps, "brands": brands, "days": days}
+
+    def rows(self, since: str = ""):
+        # Генератор: курсор отдаёт строки по мере чтения
+        yield from self.db.execute(
+            f"SELECT {', '.join(DAILY_COLUMNS)} FROM daily_stats WHERE day >= ? ORDER BY day", (since,)
+        )
+
+    def backfill(self) -> int:
+        # Пересчёт отправленных по уже записанным заявкам (база до появления счётчиков).
+        # Брошенные формы по истории не восстановить — они считаются с момента обновления
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM daily_stats WHERE outcome = ?", (DONE,))
+            return self.db.execute(
+                "INSERT INTO daily_stats (day, mode, brand, outcome, step, count)"
+                " SELECT date(created_at, 'unixepoch', 'localtime'), mode, brand, ?, '', COUNT(*)"
+                " FROM tickets GROUP BY 1, 2, 3",
+                (DONE,),
+            ).rowcount
+
+
+def ticket_rows(db: sqlite3.Connection, since: str = ""):
+    # Заявки без персональных данных (имя, телефон, адрес не выгружаются)
+    started = time.mktime(time.strptime(since, "%Y-%m-%d")) if since else 0
+    for row in db.execute(
+        "SELECT id, created_at, flow, mode, status, brand FROM tickets WHERE created_at >= ? ORDER BY id", (started,)
+    ):
+        yield (row[0], time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(row[1])), *row[2:])
+
+
+def write_csv(rows, columns: tuple, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_jsonl(rows, columns: tuple, out):
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка статистики и заявок")
+    parser.add_argument("what", choices=("daily", "tickets", "backfill"),
+                        help="daily — счётчики по дням, tickets — заявки, backfill — пересчитать отправленные")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    parser.add_argument("--since", default="", help="с какого дня, ГГГГ-ММ-ДД")
+    parser.add_argument("--db", default=os.getenv("TICKETS_PATH", "tickets.db"), help="база заявок")
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.db, isolation_level=None)
+    stats = DailyStats(db)
+    if args.what == "backfill":
+        print(f"строк счётчиков: {stats.backfill()}", file=sys.stderr)
+        return
+    if args.what == "daily":
+        rows, columns = stats.rows(args.since), DAILY_COLUMNS
+    else:
+        rows, columns = ticket_rows(db, args.since), TICKET_COLUMNS
+    write = write_csv if args.format == "csv" else write_jsonl
+    write(rows, columns, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
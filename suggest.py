@@ -0,0 +1,178 @@
+# ==========================
+# Подсказки брендов и моделей по началу слова
+#
+# Поиск по префиксу — два bisect по отсортированному массиву ключей и
+# короткий проход по диапазону. Ключ — начало каждого слова значения, так
+# что «m404» находит «LaserJet Pro M404dn». Строка значения хранится одна:
+# ключ — это число (номер значения, смещение слова), а текст ключа
+# берётся срезом строки при сравнении. Так на модель уходит ~100 байт,
+# а индексы по брендам делят строки с общим индексом.
+#
+# Вес значения — сколько раз его выбирали. Новые заявки добавляются по
+# одной, без перестройки; при загрузке каталога и истории ключи копятся и
+# сортируются разом перед первым поиском. Короткие префиксы (диапазон у
+# них большой) кэшируются, кэш сбрасывается точечно при изменении веса.
+# ==========================
+import bisect
+import heapq
+import json
+from array import array
+
+CACHED_PREFIX = 2  # префиксы до стольких символов кэшируются
+INSORT_PENDING = 64  # столько новых ключей вставляются по одному, больше — пересортировка
+OFFSET_BITS = 8  # слова дальше 255-го символа значения не индексируются
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+class PrefixIndex:
+    __slots__ = ("_strings", "_ref", "_weight", "_keys", "_pending", "_fresh", "_cache")
+
+    def __init__(self, strings: list = None):
+        self._strings = [] if strings is None else strings  # написания значений; общие с индексом вида
+        self._ref = array("L")  # номер значения -> номер строки в _strings
+        self._weight = array("L")
+        self._keys = array("Q")  # номер значения << OFFSET_BITS | смещение слова, по тексту ключа
+        self._pending = []  # ключи, ещё не вставленные в _keys
+        self._fresh = {}  # нормализованное значение -> номер, для добавленных после сортировки
+        self._cache = {}  # (префикс, limit) -> список
+
+    def add(self, value: str, weight: int = 1, ref: int = None) -> int:
+        # Возвращает номер строки — по нему индекс бренда берёт то же написание
+        value = " ".join(value.split())
+        norm = value.casefold()
+        if not norm:
+            return None
+        item = self._find(norm)
+        if item is None:
+            if ref is None:
+                ref = len(self._strings)
+                self._strings.append(value)
+            item = len(self._ref)
+            self._ref.append(ref)
+            self._weight.append(weight)
+            self._fresh[norm] = item
+            self._pending.extend(item << OFFSET_BITS | offset for offset in self._word_offsets(norm))
+        else:
+            self._weight[item] += weight
+        self._drop_cached(norm)
+        return self._ref[item]
+
+    def exact(self, value: str):
+        # Написание из индекса для того же значения (регистр, пробелы) или None
+        item = self._find(normalize(value))
+        return None if item is None else self._strings[self._ref[item]]
+
+    def search(self, prefix: str, limit: int = 5) -> list:
+        # Самые частые значения, у которых какое-то слово начинается с prefix
+        prefix = normalize(prefix)
+        if self._pending:
+            self._merge()
+        cached = len(prefix) <= CACHED_PREFIX
+        if cached and (prefix, limit) in self._cache:
+            return self._cache[prefix, limit]
+        start = bisect.bisect_left(self._keys, prefix, key=self._text)
+        end = bisect.bisect_left(self._keys, prefix + "\U0010ffff", start, key=self._text)
+        items = {key >> OFFSET_BITS for key in self._keys[start:end]}
+        strings, ref, weight = self._strings, self._ref, self._weight
+        best = heapq.nsmallest(limit, items, key=lambda item: (-weight[item], strings[ref[item]]))
+        result = [strings[ref[item]] for item in best]
+        if cached:
+            self._cache[prefix, limit] = result
+        return result
+
+    def _text(self, key: int) -> str:
+        return self._strings[self._ref[key >> OFFSET_BITS]][key & ((1 << OFFSET_BITS) - 1):].casefold()
+
+    def _find(self, norm: str):
+        item = self._fresh.get(norm)
+        if item is not None:
+            return item
+        # Ключ с нулевым смещением и тем же текстом — само значение, а не хвост другого
+        pos = bisect.bisect_left(self._keys, norm, key=self._text)
+        while pos < len(self._keys) and self._text(self._keys[pos]) == norm:
+            if not self._keys[pos] & ((1 << OFFSET_BITS) - 1):
+                return self._keys[pos] >> OFFSET_BITS
+            pos += 1
+        return None
+
+    def _merge(self):
+        pending, self._pending = self._pending, []
+        self._fresh.clear()
+        if len(pending) <= INSORT_PENDING:
+            for key in pending:
+                bisect.insort_left(self._keys, key, key=self._text)
+            return
+        pending.extend(self._keys)
+        pending.sort(key=self._text)
+        self._keys = array("Q", pending)
+
+    @staticmethod
+    def _word_offsets(norm: str) -> list:
+        offsets = [0] + [i + 1 for i, char in enumerate(norm) if char == " "]
+        return [offset for offset in offsets if offset < 1 << OFFSET_BITS]
+
+    def _drop_cached(self, norm: str):
+        if not self._cache:
+            return
+        prefixes = {norm[offset:offset + n] for offset in self._word_offsets(norm) for n in range(CACHED_PREFIX + 1)}
+        for cached in [cached for cached in self._cache if cached[0] in prefixes]:
+            del self._cache[cached]
+
+    def __len__(self):
+        return len(self._ref)
+
+
+class Suggestions:
+    # Индексы по видам (type, brand, model, cartridge). Модели и картриджи ещё и
+    # по бренду (scope): сначала предлагаются модели выбранного бренда, потом остальные.
+    def __init__(self):
+        self._indexes = {}  # (вид, scope) -> PrefixIndex
+
+    def learn(self, kind: str, value: str, scope: str = "", weight: int = 1):
+        ref = self._index(kind, "").add(value, weight)
+        if scope and ref is not None:
+            self._index(kind, normalize(scope)).add(value, weight, ref)
+
+    def exact(self, kind: str, value: str):
+        index = self._indexes.get((kind, ""))
+        return index.exact(value) if index else None
+
+    def search(self, kind: str, prefix: str, scope: str = "", limit: int = 5, fallback: bool = True) -> list:
+        # fallback=False — только в пределах scope (если он задан)
+        result = []
+        keys = [(kind, normalize(scope))] if scope else []
+        if fallback or not scope:
+            keys.append((kind, ""))
+        for key in keys:
+            index = self._indexes.get(key)
+            if index is None:
+                continue
+            for value in index.search(prefix, limit):
+                if value not in result:
+                    result.append(value)
+            if len(result) >= limit:
+                break
+        return result[:limit]
+
+    def load_catalog(self, path: str) -> int:
+        # {"type": [...], "brand": [...], "model": {"бренд": [...]}, "cartridge": {"бренд": [...]}}
+        with open(path, encoding="utf-8") as source:
+            catalog = json.load(source)
+        count = 0
+        for kind, values in catalog.items():
+            scoped = values.items() if isinstance(values, dict) else (("", values),)
+            for scope, names in scoped:
+                for name in names:
+                    self.learn(kind, name, scope)
+                    count += 1
+        return count
+
+    def _index(self, kind: str, scope: str) -> PrefixIndex:
+        index = self._indexes.get((kind, scope))
+        if index is None:
+            shared = self._indexes[kind, ""]._strings if scope else None
+            index = self._indexes[kind, scope] = PrefixIndex(shared)
+        return index
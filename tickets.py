@@ -0,0 +1,174 @@
+# ==========================
+# Хранилище заявок (SQLite)
+#
+# Каждая подтверждённая заявка записывается сюда до отправки операторам,
+# чтобы её можно было найти по телефону или бренду и вести по статусам.
+# Рядом — счётчики по дням (stats.py), отправленная заявка попадает в них
+# той же транзакцией.
+# Списки листаются по ключу (id < последний показанный), а не через
+# OFFSET: любая страница — это короткий проход по индексу, сколько бы
+# заявок ни накопилось.
+# ==========================
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+
+from phones import normalize_phone
+from stats import DONE as STATS_DONE, DailyStats
+
+NEW, WORK, DONE, CANCELLED = "new", "work", "done", "cancelled"
+STATUSES = (NEW, WORK, DONE, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    flow TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'new',
+    user_id INTEGER NOT NULL,
+    phone TEXT NOT NULL,
+    brand TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tickets_phone ON tickets (phone, id);
+CREATE INDEX IF NOT EXISTS tickets_flow ON tickets (flow, id);
+CREATE INDEX IF NOT EXISTS tickets_brand ON tickets (brand, id);
+CREATE INDEX IF NOT EXISTS tickets_created ON tickets (created_at);
+CREATE INDEX IF NOT EXISTS tickets_open ON tickets (id) WHERE status IN ('new', 'work');
+"""
+
+# Условие должно совпадать с WHERE частичного индекса tickets_open
+OPEN_WHERE = "status IN ('new', 'work')"
+
+def phone_key(text: str) -> str:
+    return normalize_phone(text) or text.strip()
+
+
+def normalize_brand(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+class TicketStore:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.stats = DailyStats(self.db)
+
+    def add(self, key: str, flow: str, mode: str, user_id: int, phone: str, brand: str, data: dict) -> int:
+        # Повтор с тем же ключом (апдейт пришёл ещё раз) возвращает уже записанную заявку
+        now = time.time()
+        # Заявка и её счётчик — вместе; SAVEPOINT работает и внутри внешней транзакции
+        self.db.execute("SAVEPOINT add_ticket")
+        try:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO tickets (key, flow, mode, user_id, phone, brand, data, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, flow, mode, user_id, phone_key(phone), normalize_brand(brand),
+                 json.dumps(data, ensure_ascii=False), now, now),
+            )
+            if cur.rowcount == 1:
+                self.stats.add(mode, normalize_brand(brand), STATS_DONE, when=now)
+        except BaseException:
+            self.db.execute("ROLLBACK TO add_ticket")
+            raise
+        finally:
+            self.db.execute("RELEASE add_ticket")
+        if cur.rowcount == 1:
+            return cur.lastrowid
+        return self.db.execute("SELECT id FROM tickets WHERE key = ?", (key,)).fetchone()[0]
+
+    def get(self, ticket_id: int):
+        return self.db.execute("SELECT * FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+
+    def by_key(self, key: str):
+        return self.db.execute("SELECT * FROM tickets WHERE key = ?", (key,)).fetchone()
+
+    def set_status(self, ticket_id: int, status: str) -> bool:
+        if status not in STATUSES:
+            raise ValueError(f"Неизвестный статус: {status}")
+        cur = self.db.execute(
+            "UPDATE tickets SET status = ?, updated_at = ? WHERE id = ?", (status, time.time(), ticket_id)
+        )
+        return cur.rowcount == 1
+
+    # --- списки: новые сверху, before — id последней показанной заявки ---
+
+    def find_phone(self, phone: str, before: int = None, limit: int = 10, since: float = None) -> list:
+        return self._page("phone = ?", (phone_key(phone),), before, limit, since)
+
+    def find_brand(self, brand: str, before: int = None, limit: int = 10, since: float = None) -> list:
+        return self._page("brand = ?", (normalize_brand(brand),), before, limit, since)
+
+    def open_tickets(self, flow: str = None, before: int = None, limit: int = 10) -> list:
+        # Открытых заявок мало: по частичному индексу, даже если задана услуга
+        if flow:
+            return self._page(f"{OPEN_WHERE} AND flow = ?", (flow,), before, limit, index="tickets_open")
+        return self._page(OPEN_WHERE, (), before, limit, index="tickets_open")
+
+    def _page(self, where: str, params: tuple, before, limit: int, since: float = None, index: str = None) -> list:
+        if before is not None:
+            where += " AND id < ?"
+            params += (before,)
+        if since is not None:
+            where += " AND created_at >= ?"
+            params += (since,)
+        source = f"tickets INDEXED BY {index}" if index else "tickets"
+        return self.db.execute(
+            f"SELECT * FROM {source} WHERE {where} ORDER BY id DESC LIMIT ?", (*params, limit)
+        ).fetchall()
+
+    def count(self, mode: str, brand: str, outcome: str, step: str = ""):
+        # Форма без заявки: брошена на шаге step или повтор (см. stats.py)
+        self.stats.add(mode, normalize_brand(brand), outcome, step)
+
+    def field_counts(self, flow: str, keys: tuple) -> list:
+        # (значения полей data..., сколько заявок) — для подсказок при запуске
+        columns = ", ".join(f"json_extract(data, '$.{key}')" for key in keys)
+        return self.db.execute(
+            f"SELECT {columns}, COUNT(*) FROM tickets WHERE flow = ? GROUP BY {columns}", (flow,)
+        ).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+class RecentTickets:
+    # Недавние заявки в памяти: (телефон, услуга) → (когда забыть, №, хэш содержимого).
+    # Тот же телефон, услуга и хэш в пределах окна — повтор той же заявки (двойное
+    # нажатие, повторное заполнение), его не отправляем. Тот же телефон и услуга с
+    # другим содержимым — новая заявка, но операторы видят, что номер уже обращался.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def check(self, phone: str, flow: str, content_hash: int):
+        # (№ предыдущей заявки, совпало ли содержимое) или None
+        self._expire()
+        entry = self._entries.get((phone, flow))
+        if entry is None:
+            return None
+        return entry[1], entry[2] == content_hash
+
+    def remember(self, phone: str, flow: str, content_hash: int, ticket_id: int):
+        key = (phone, flow)
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, ticket_id, content_hash)
+
+    def _expire(self):
+        # Окно у всех одинаковое, поэтому словарь упорядочен по времени — чистим с начала
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry[0] > now:
+                break
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)